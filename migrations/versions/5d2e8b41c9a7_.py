@@ -0,0 +1,58 @@
+"""ON DELETE CASCADE on the favorites foreign keys
+
+Revision ID: 5d2e8b41c9a7
+Revises: a3c1f0d2b7e4
+Create Date: 2026-10-19 11:40:03.527761
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8b41c9a7'
+down_revision = 'a3c1f0d2b7e4'
+branch_labels = None
+depends_on = None
+
+FOREIGN_KEYS = [
+    ('favorite_people', 'user_id', 'user'),
+    ('favorite_people', 'people_id', 'people'),
+    ('favorite_planets', 'user_id', 'user'),
+    ('favorite_planets', 'planet_id', 'planets'),
+    ('favorite_vehicles', 'user_id', 'user'),
+    ('favorite_vehicles', 'vehicle_id', 'vehicles'),
+]
+
+# names of the foreign keys created by 48dc99c93ff4: Postgres generates them, on SQLite
+# they are unnamed and batch mode names them with this convention when reflecting
+SQLITE_NAMING = {"fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s"}
+
+
+def _old_name(table, column, referred, dialect):
+    if dialect == 'sqlite':
+        return 'fk_%s_%s_%s' % (table, column, referred)
+    return '%s_%s_fkey' % (table, column)
+
+
+def _new_name(table, column, referred, dialect):
+    return 'fk_%s_%s_%s' % (table, column, referred)
+
+
+def _swap_foreign_keys(old_names, new_names, ondelete):
+    dialect = op.get_bind().dialect.name
+    for table in ('favorite_people', 'favorite_planets', 'favorite_vehicles'):
+        with op.batch_alter_table(table, naming_convention=SQLITE_NAMING) as batch_op:
+            for fk_table, column, referred in FOREIGN_KEYS:
+                if fk_table != table:
+                    continue
+                batch_op.drop_constraint(old_names(table, column, referred, dialect), type_='foreignkey')
+                batch_op.create_foreign_key(new_names(table, column, referred, dialect), referred, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    _swap_foreign_keys(_old_name, _new_name, 'CASCADE')
+
+
+def downgrade():
+    _swap_foreign_keys(_new_name, _old_name, None)
@@ -0,0 +1,25 @@
+"""user.token_version for the identity claims of the access tokens
+
+Revision ID: 8f3d6c1b0a92
+Revises: e4b9a27c5f13
+Create Date: 2026-10-19 17:48:55.213874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f3d6c1b0a92'
+down_revision = 'e4b9a27c5f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('token_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('token_version')
@@ -0,0 +1,75 @@
+"""change_seq counters for the /changes feed instead of updated_at
+
+Revision ID: 9c4e1f7a2b58
+Revises: f2a8c6e1d437
+Create Date: 2026-10-19 21:04:17.530912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e1f7a2b58'
+down_revision = 'f2a8c6e1d437'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('catalog_change_counter',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('favorite_change_counter',
+    sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+    # las filas existentes quedan en 0: las trae una sincronizacion completa
+    for table in ('people', 'planets', 'vehicles'):
+        op.add_column(table, sa.Column('change_seq', sa.BigInteger(), server_default='0', nullable=False))
+        op.drop_index(op.f('ix_%s_updated_at' % table), table_name=table)
+        op.create_index(op.f('ix_%s_change_seq' % table), table, ['change_seq'], unique=False)
+
+    for table in ('favorite_people', 'favorite_planets', 'favorite_vehicles'):
+        op.add_column(table, sa.Column('change_seq', sa.BigInteger(), server_default='0', nullable=False))
+        op.drop_index('ix_%s_user_id_updated_at' % table, table_name=table)
+        op.create_index('ix_%s_user_id_change_seq' % table, table, ['user_id', 'change_seq'], unique=False)
+
+    op.add_column('tombstone', sa.Column('change_seq', sa.BigInteger(), server_default='0', nullable=False))
+    op.drop_index('ix_tombstone_kind_deleted_at', table_name='tombstone')
+    op.create_index('ix_tombstone_kind_change_seq', 'tombstone', ['kind', 'change_seq'], unique=False)
+
+    op.add_column('favorite_tombstone', sa.Column('change_seq', sa.BigInteger(), server_default='0', nullable=False))
+    op.drop_index('ix_favorite_tombstone_user_id_deleted_at', table_name='favorite_tombstone')
+    op.create_index('ix_favorite_tombstone_user_id_change_seq', 'favorite_tombstone', ['user_id', 'change_seq'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_favorite_tombstone_user_id_change_seq', table_name='favorite_tombstone')
+    op.create_index('ix_favorite_tombstone_user_id_deleted_at', 'favorite_tombstone', ['user_id', 'deleted_at'], unique=False)
+    with op.batch_alter_table('favorite_tombstone') as batch_op:
+        batch_op.drop_column('change_seq')
+
+    op.drop_index('ix_tombstone_kind_change_seq', table_name='tombstone')
+    op.create_index('ix_tombstone_kind_deleted_at', 'tombstone', ['kind', 'deleted_at'], unique=False)
+    with op.batch_alter_table('tombstone') as batch_op:
+        batch_op.drop_column('change_seq')
+
+    for table in ('favorite_people', 'favorite_planets', 'favorite_vehicles'):
+        op.drop_index('ix_%s_user_id_change_seq' % table, table_name=table)
+        op.create_index('ix_%s_user_id_updated_at' % table, table, ['user_id', 'updated_at'], unique=False)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('change_seq')
+
+    for table in ('people', 'planets', 'vehicles'):
+        op.drop_index(op.f('ix_%s_change_seq' % table), table_name=table)
+        op.create_index(op.f('ix_%s_updated_at' % table), table, ['updated_at'], unique=False)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('change_seq')
+
+    op.drop_table('favorite_change_counter')
+    op.drop_table('catalog_change_counter')
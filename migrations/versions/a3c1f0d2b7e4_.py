@@ -0,0 +1,68 @@
+"""add updated_at columns and tombstones for the /changes feed
+
+Revision ID: a3c1f0d2b7e4
+Revises: 48dc99c93ff4
+Create Date: 2026-10-19 09:12:40.118204
+
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c1f0d2b7e4'
+down_revision = '48dc99c93ff4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    for table in ('people', 'planets', 'vehicles'):
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute(sa.table(table, sa.column('updated_at')).update().values(updated_at=now))
+        op.create_index(op.f('ix_%s_updated_at' % table), table, ['updated_at'], unique=False)
+
+    for table in ('favorite_people', 'favorite_planets', 'favorite_vehicles'):
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute(sa.table(table, sa.column('updated_at')).update().values(updated_at=now))
+        op.create_index('ix_%s_user_id_updated_at' % table, table, ['user_id', 'updated_at'], unique=False)
+
+    op.create_table('tombstone',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_tombstone_kind_deleted_at', 'tombstone', ['kind', 'deleted_at'], unique=False)
+
+    op.create_table('favorite_tombstone',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('item_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_favorite_tombstone_user_id_deleted_at', 'favorite_tombstone', ['user_id', 'deleted_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_favorite_tombstone_user_id_deleted_at', table_name='favorite_tombstone')
+    op.drop_table('favorite_tombstone')
+    op.drop_index('ix_tombstone_kind_deleted_at', table_name='tombstone')
+    op.drop_table('tombstone')
+
+    for table in ('favorite_people', 'favorite_planets', 'favorite_vehicles'):
+        op.drop_index('ix_%s_user_id_updated_at' % table, table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+
+    for table in ('people', 'planets', 'vehicles'):
+        op.drop_index(op.f('ix_%s_updated_at' % table), table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
@@ -0,0 +1,29 @@
+"""version column on user and the catalog for If-Match / optimistic concurrency
+
+Revision ID: b5e0d7a3f218
+Revises: 8f3d6c1b0a92
+Create Date: 2026-10-19 18:41:07.530129
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e0d7a3f218'
+down_revision = '8f3d6c1b0a92'
+branch_labels = None
+depends_on = None
+
+TABLES = ('user', 'people', 'planets', 'vehicles')
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('version')
@@ -0,0 +1,33 @@
+"""catalog_stat table for the /stats rollups
+
+Revision ID: c71f4a9e2d06
+Revises: 5d2e8b41c9a7
+Create Date: 2026-10-19 14:05:31.662090
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71f4a9e2d06'
+down_revision = '5d2e8b41c9a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('catalog_stat',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('metric', sa.String(length=40), nullable=False),
+    sa.Column('bucket', sa.String(length=80), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('kind', 'metric', 'bucket', name='uq_catalog_stat_kind_metric_bucket')
+    )
+    # los contadores se llenan con `flask stats-rebuild`
+
+
+def downgrade():
+    op.drop_table('catalog_stat')
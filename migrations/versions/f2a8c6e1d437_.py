@@ -0,0 +1,40 @@
+"""audit_log table written in batches by the audit writer thread
+
+Revision ID: f2a8c6e1d437
+Revises: b5e0d7a3f218
+Create Date: 2026-10-19 19:36:52.118640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a8c6e1d437'
+down_revision = 'b5e0d7a3f218'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('audit_log',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('event', sa.String(length=40), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('email', sa.String(length=120), nullable=True),
+    sa.Column('kind', sa.String(length=20), nullable=True),
+    sa.Column('item_id', sa.Integer(), nullable=True),
+    sa.Column('ip', sa.String(length=45), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_audit_log_user_id_created_at', 'audit_log', ['user_id', 'created_at'], unique=False)
+    op.create_index('ix_audit_log_event_created_at', 'audit_log', ['event', 'created_at'], unique=False)
+    op.create_index('ix_audit_log_created_at', 'audit_log', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_audit_log_created_at', table_name='audit_log')
+    op.drop_index('ix_audit_log_event_created_at', table_name='audit_log')
+    op.drop_index('ix_audit_log_user_id_created_at', table_name='audit_log')
+    op.drop_table('audit_log')
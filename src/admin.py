@@ -1,7 +1,69 @@
 import os
+import sqlalchemy as sa
 from flask_admin import Admin
 from models import db, User, People, Planets, Vehicles, FavoritePeople, FavoritePlanets, FavoriteVehicles, TokenBlockedList
 from flask_admin.contrib.sqla import ModelView
+from sharding import shards, fan_out, purge_favorites
+import stats
+import snapshot
+
+class CatalogModelView(ModelView):
+    """People, planets or vehicles: the admin writes keep /stats, the favorites tombstones and
+    the catalog snapshot up to date like the API endpoints."""
+    form_excluded_columns = ("updated_at", "change_seq", "version") # los pone la base de datos o los eventos del modelo
+
+    def __init__(self, model, favorite_model, session, **kwargs):
+        self.favorite_model = favorite_model
+        super().__init__(model, session, **kwargs)
+
+    def on_model_change(self, form, model, is_created):
+        # antes del commit: los contadores de /stats van en la misma transaccion
+        kind = model.__tablename__
+        if is_created:
+            stats.add_rows(kind, [model.serialize()])
+            return
+
+        state = sa.inspect(model)
+        old = {}
+        for column in stats.stat_columns(kind):
+            history = state.attrs[column.key].history
+            old[column.key] = history.deleted[0] if history.deleted else getattr(model, column.key)
+        stats.replace_row(kind, old, model.serialize())
+
+    def on_model_delete(self, model):
+        stats.remove_rows(model.__tablename__, [model.serialize()])
+        purge_favorites(self.favorite_model, getattr(self.favorite_model, self.favorite_model.item_column) == model.id)
+
+    def after_model_change(self, form, model, is_created):
+        snapshot.catalog_changed()
+
+    def after_model_delete(self, model):
+        snapshot.catalog_changed()
+
+class ShardedModelView(ModelView):
+    """Read-only list of a sharded favorites table, every shard is queried in parallel."""
+    can_create = False
+    can_edit = False
+    can_delete = False
+
+    def __init__(self, model, session, **kwargs):
+        # solo columnas, las relaciones apuntan a tablas de otra base de datos
+        self.column_list = [column.name for column in model.__table__.columns]
+        super().__init__(model, session, **kwargs)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        page = page or 0
+        page_size = page_size or self.page_size
+        limit = (page + 1) * page_size
+
+        results = fan_out(lambda: super(ShardedModelView, self).get_list(0, sort_column, sort_desc, search, filters, page_size=limit))
+
+        sort_key = sort_column or "id"
+        rows = sorted((row for count, shard_rows in results for row in shard_rows),
+                      key=lambda row: getattr(row, sort_key), reverse=bool(sort_desc))
+        count = sum(count or 0 for count, shard_rows in results)
+
+        return count, rows[page * page_size:limit]
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
@@ -11,12 +73,13 @@ def setup_admin(app):
     
     # Add your models here, for example this is how we add a the User model to the admin
     admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(People, db.session))
-    admin.add_view(ModelView(Planets, db.session))
-    admin.add_view(ModelView(Vehicles, db.session))
-    admin.add_view(ModelView(FavoritePeople, db.session))
-    admin.add_view(ModelView(FavoritePlanets, db.session))
-    admin.add_view(ModelView(FavoriteVehicles, db.session))
+    admin.add_view(CatalogModelView(People, FavoritePeople, db.session))
+    admin.add_view(CatalogModelView(Planets, FavoritePlanets, db.session))
+    admin.add_view(CatalogModelView(Vehicles, FavoriteVehicles, db.session))
+    FavoritesView = ShardedModelView if shards.keys else ModelView
+    admin.add_view(FavoritesView(FavoritePeople, db.session))
+    admin.add_view(FavoritesView(FavoritePlanets, db.session))
+    admin.add_view(FavoritesView(FavoriteVehicles, db.session))
     admin.add_view(ModelView(TokenBlockedList, db.session))
 
     # You can duplicate that line to add mew models
@@ -6,9 +6,25 @@ from flask import Flask, request, jsonify, url_for
 from flask_migrate import Migrate
 from flask_swagger import swagger
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
+from utils import APIException, generate_sitemap, parse_fields, parse_include
 from admin import setup_admin
-from models import db, User, People, Planets, Vehicles, FavoritePeople, FavoritePlanets, FavoriteVehicles, TokenBlockedList
+from routing import configure_replicas, read_only
+from singleflight import single_flight
+from sharding import configure_sharding, shards, use_shard, fan_out, purge_favorites, purge_user_favorites
+from slowlog import setup_slow_query_log
+from traffic import setup_traffic_capture
+from negotiation import setup_msgpack
+from identity import setup_identity, token_versions, identity_claims, user_from_claims
+import stats
+import snapshot
+import jobs
+import recommendations
+import dbjson
+import queries
+import audit
+from warmup import setup_warmup, warmup
+from profiling import setup_profiling
+from models import db, utcnow, select_fields, User, People, Planets, Vehicles, FavoritePeople, FavoritePlanets, FavoriteVehicles, TokenBlockedList, Tombstone, FavoriteTombstone, CatalogChangeCounter, FavoriteChangeCounter, next_catalog_seq
 #from models import Person
 
 from flask_jwt_extended import create_access_token
@@ -19,13 +35,17 @@ from flask_jwt_extended import JWTManager
 from datetime import date, time, datetime, timezone, timedelta
 
 from flask_bcrypt import Bcrypt
+from sqlalchemy import select, insert, update, delete, literal, and_
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
+setup_msgpack(app) #Accept / Content-Type: application/msgpack ademas de JSON
 
 #inicio de instancia de JWT
 app.config["JWT_SECRET_KEY"] = os.getenv("FLASK_APP_KEY")
 jwt = JWTManager(app)
+setup_identity(jwt) #email y name viajan en el token, token_version invalida los tokens viejos
+app.config["INTERNAL_API_KEY"] = os.getenv("INTERNAL_API_KEY") #header X-Internal-Key de los endpoints /internal
 
 bcrypt = Bcrypt(app) #inicio mi instancia de Bcrypt
 
@@ -35,21 +55,123 @@ if db_url is not None:
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+configure_replicas(app) #replicas de lectura opcionales (DATABASE_REPLICA_URLS)
+configure_sharding(app) #shards opcionales para los favoritos (FAVORITES_SHARD_URLS)
 
 MIGRATE = Migrate(app, db)
 db.init_app(app)
 CORS(app)
 setup_admin(app)
+setup_slow_query_log(app, db)
+queries.setup_queries(app) #aciertos del cache de sentencias compiladas en /internal/queries
+stats.setup_stats(app)
+snapshot.setup_snapshot(app) #snapshot del catalogo compartido por los workers (CATALOG_SNAPSHOT_PATH)
+jobs.setup_jobs(app) #trabajos en segundo plano, `flask jobs-worker`
+audit.setup_audit(app) #auditoria de login, logout y favoritos, escrita en lotes por un thread
+recommendations.setup_recommendations(app)
+dbjson.setup_db_json(app) #?render=db: el JSON de las listas y favoritos lo arma la base de datos
+setup_warmup(app) #/healthz, /readyz y `flask warmup`
+setup_profiling(app) #X-Profile: sample|cprofile con la clave interna (PROFILE_DIR)
+setup_traffic_capture(app) #grabacion opcional del trafico (TRAFFIC_CAPTURE_PATH) y `flask traffic-replay`
 
 def verificacionToken(jti):
     jti#Identificador del JWT (es más corto)
     print("jit", jti)
-    token = TokenBlockedList.query.filter_by(token=jti).first()
-
-    if token is None:
-        return False
-    
-    return True
+    return queries.token_blocked(jti)
+
+def delete_catalog_rows(model, favorite_model, condition):
+    """Borra las filas del catalogo que cumplen condition con un solo DELETE, los favoritos
+    se van por ON DELETE CASCADE. Deja los tombstones para /changes, descuenta /stats y
+    devuelve cuantas se borraron."""
+    ids = select(model.id).where(condition)
+    if shards.keys:
+        ids = db.session.execute(ids).scalars().all() #los shards son otra base de datos, no sirve la subconsulta
+    purge_favorites(favorite_model, getattr(favorite_model, favorite_model.item_column).in_(ids))
+
+    db.session.execute(insert(Tombstone).from_select(
+        ["kind", "row_id", "deleted_at", "change_seq"],
+        select(literal(model.__tablename__), model.id, literal(utcnow()), literal(next_catalog_seq(db.session))).where(condition)
+    ))
+    #RETURNING da los valores borrados para descontarlos de /stats sin otra consulta
+    statement = delete(model).where(condition)
+    stat_columns = stats.stat_columns(model.__tablename__)
+    if getattr(db.engine.dialect, "delete_returning", False):
+        deleted_rows = db.session.execute(statement.returning(*stat_columns)).mappings().all()
+    else:
+        deleted_rows = db.session.execute(select(*stat_columns).where(condition)).mappings().all()
+        db.session.execute(statement)
+    stats.remove_rows(model.__tablename__, deleted_rows)
+
+    return len(deleted_rows)
+
+UPDATE_RETRIES = 3 #sin If-Match, cuantas veces reintentar si otro UPDATE gana entre la lectura de /stats y el nuestro
+
+def if_match_versions():
+    """Versiones que acepta el If-Match (el ETag es "v<version>"), None sin If-Match o con *.
+    Un If-Match sin ninguna version nuestra nunca se cumple."""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = [int(tag[1:]) for tag in request.if_match.as_set() if tag[:1] == "v" and tag[1:].isdigit()]
+    if not versions:
+        raise APIException('Precondition failed: If-Match does not match the current version', status_code=412)
+    return versions
+
+def versioned(row, status=200):
+    """Respuesta con la fila sin su version, que va en el ETag para el If-Match del proximo PATCH/PUT."""
+    row = dict(row)
+    version = row.pop("version")
+    response = jsonify(row)
+    response.set_etag("v%d" % version)
+    return response, status
+
+def conditional_update(model, id, values, kind=None, not_found='no encontrado'):
+    """UPDATE ... SET version = version + 1 WHERE id = ? AND version = ? RETURNING las columnas
+    de model: sin cargar el objeto antes y sin pisar una escritura concurrente. La version sale
+    del If-Match (412 si ya no es la actual). Si values cambia columnas de /stats de kind hay que
+    leer los valores viejos antes, y el UPDATE usa la version leida. Devuelve la fila nueva con
+    su version."""
+    expected = if_match_versions()
+    columns = [getattr(model, field) for field in model.FIELDS] + [model.version]
+    stat_columns = stats.stat_columns(kind) if kind else []
+    if not any(column.key in values for column in stat_columns):
+        stat_columns = []
+    if "change_seq" in model.__table__.c:
+        values = dict(values, change_seq=next_catalog_seq(db.session)) #antes que el UPDATE, el contador ordena a los escritores
+
+    for attempt in range(UPDATE_RETRIES):
+        condition = [model.id == id]
+        old = None
+        if stat_columns:
+            old = db.session.execute(select(model.version, *stat_columns).where(model.id == id)).mappings().first()
+            if old is None:
+                raise APIException(not_found, status_code=404)
+            if expected is not None and old["version"] not in expected:
+                break
+            condition.append(model.version == old["version"])
+        elif expected is not None:
+            condition.append(model.version.in_(expected))
+
+        statement = update(model).where(*condition).values(version=model.version + 1, **values) \
+            .execution_options(synchronize_session=False)
+        if getattr(db.engine.dialect, "update_returning", False):
+            row = db.session.execute(statement.returning(*columns)).mappings().first()
+        elif db.session.execute(statement).rowcount:
+            row = db.session.execute(select(*columns).where(model.id == id)).mappings().first()
+        else:
+            row = None
+
+        if row is not None:
+            if old is not None:
+                stats.replace_row(kind, old, row)
+            return dict(row)
+        if old is None or expected is not None:
+            break #sin lectura previa un UPDATE vacio es 404 o If-Match viejo; con If-Match no se reintenta
+
+    if db.session.execute(select(model.id).where(model.id == id)).first() is None:
+        raise APIException(not_found, status_code=404)
+    if expected is None:
+        raise APIException('Conflict: the row kept changing, try again', status_code=409)
+    raise APIException('Precondition failed: If-Match does not match the current version', status_code=412)
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
@@ -62,9 +184,10 @@ def sitemap():
     return generate_sitemap(app)
 
 @app.route('/user', methods=['GET'])
+@read_only
+@single_flight
 def handle_hello():
-    users = User.query.all()
-    users = list(map(lambda item: item.serialize(), users))
+    users = select_fields(User, parse_fields(User.FIELDS)) #solo las columnas pedidas en ?fields=
 
     #return jsonify(users), 200
 
@@ -94,7 +217,7 @@ def register_user():
     if "is_active" not in body:
         raise APIException("You need to specify the is_active", status_code=400)
     
-    user = User.query.filter_by(email=email).first()
+    user = queries.user_by_email(email)
     if user is not None:
         raise APIException("Email is already registered", status_code=409)
     
@@ -113,16 +236,19 @@ def login():
     email=body["email"]
     password = body["password"]
 
-    user = User.query.filter_by(email=email).first()
+    user = queries.user_by_email(email)
 
     if user is None:
+        audit.record("login_failed", email=email)
         return jsonify({"message":"Login failed"}), 401
 
     #validar el password encriptado
     if not bcrypt.check_password_hash(user.password, password):
+        audit.record("login_failed", user.id, email)
         return jsonify({"message":"Login failed"}), 401
     
-    access_token = create_access_token(identity=user.id)
+    access_token = create_access_token(identity=user.id, additional_claims=identity_claims(user))
+    audit.record("login", user.id, email) #a la cola, lo escribe el thread de audit.py
     return jsonify({"token":access_token}), 200
 
 @app.route('/logout', methods=['POST'])
@@ -131,54 +257,75 @@ def logout():
     jti = get_jwt()["jti"] #Identificador del JWT (es más corto)
     now = datetime.now(timezone.utc)
 
-    #identificamos al usuario
-    current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    #identificamos al usuario con los claims del token, sin ir a la base de datos
+    email = get_jwt()["email"]
 
-    tokenBlocked = TokenBlockedList(token=jti , created_at=now, email=user.email)
+    tokenBlocked = TokenBlockedList(token=jti , created_at=now, email=email)
     db.session.add(tokenBlocked)
     db.session.commit()
+    audit.record("logout", get_jwt_identity(), email)
 
     return jsonify({"message":"logout successfully"})
 
+@app.route('/logout-all', methods=['POST'])
+@jwt_required()
+def logout_all():
+    #un solo UPDATE invalida todos los tokens del usuario, sin una fila por token en TokenBlockedList
+    token_versions.bump(get_jwt_identity())
+    db.session.commit()
+    audit.record("logout_all", get_jwt_identity(), get_jwt()["email"])
+
+    return jsonify({"message":"logout from every session successfully"})
+
 @app.route("/protected", methods=["GET"])
 @jwt_required()
 def protected():
-    # Access the identity of the current user with get_jwt_identity
-    current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    # Access the identity of the current user with the claims of the token
+    user = user_from_claims(get_jwt())
 
     token = verificacionToken(get_jwt()["jti"]) #reuso la función de verificacion de token
     if token:
        raise APIException('Token está en lista negra', status_code=404)
 
-    print("EL usuario es: ", user.name)
+    print("EL usuario es: ", user["name"])
     return jsonify({"message":"Estás en una ruta protegida"}), 200
 
 @app.route('/user/<int:id>', methods=['GET'])
+@read_only
+@single_flight
 def get_specific_user(id):
-    user = User.query.get(id)    
-  
-    return jsonify(user.serialize()), 200
+    user = select_fields(User, parse_fields(User.FIELDS) + ("version",), User.id == id)
+    if not user:
+        raise APIException('usuario no encontrado', status_code=404)
+
+    return versioned(user[0])
 
 @app.route('/user-with-post', methods=['POST'])
+@read_only
 def get_specific_user_with_post():
     body = request.get_json()   
     id = body["id"]
 
-    user = User.query.get(id)   
-  
-    return jsonify(user.serialize()), 200
+    user = select_fields(User, parse_fields(User.FIELDS), User.id == id)
+    if not user:
+        raise APIException('usuario no encontrado', status_code=404)
+
+    return jsonify(user[0]), 200
 
 @app.route('/user', methods=['DELETE'])
 def delete_specific_user():
     body = request.get_json()   
     id = body["id"]
 
-    user = User.query.get(id) 
+    #sin tombstones: el usuario ya no existe, nadie va a sincronizar sus favoritos
+    purge_user_favorites(id)
+
+    result = db.session.execute(delete(User).where(User.id == id))
+    if result.rowcount == 0:
+        raise APIException('usuario no encontrado', status_code=404)
 
-    db.session.delete(user)
     db.session.commit()  
+    token_versions.forget(id) #sus tokens dejan de valer (en los otros workers al vencer el cache)
   
     return jsonify("Usuario borrado"), 200
 
@@ -193,21 +340,47 @@ def edit_user():
     if "id" not in body:
         raise APIException("You need to specify the id", status_code=400)
 
-    user = User.query.get(id)   
-    user.name = name #modificamos el nombre en base de datos
+    user = conditional_update(User, id, user_values({"name": name}), not_found='usuario no encontrado') #un solo UPDATE, If-Match opcional
 
     db.session.commit()
+    token_versions.forget(id)
   
-    return jsonify(user.serialize()), 200
+    return versioned(user)
+
+@app.route('/user/<int:id>', methods=['PATCH'])
+def patch_user(id):
+    user = conditional_update(User, id, user_values(patch_values(request.get_json(), User, ("name",))), not_found='usuario no encontrado')
+
+    db.session.commit()
+    token_versions.forget(id)
+
+    return versioned(user)
+
+def user_values(values):
+    """El email y el nombre viajan en los claims del token: si cambian, el mismo UPDATE sube
+    token_version y los tokens emitidos antes dejan de valer."""
+    if "name" in values or "email" in values:
+        values = dict(values, token_version=User.token_version + 1)
+    return values
 
 ############################################################# PEOPLE:
 ############################################################# PEOPLE:
 ############################################################# PEOPLE:
 
 @app.route('/people', methods=['GET'])
+@read_only
+@single_flight
 def get_all_people():
-    people = People.query.all()
-    people = list(map(lambda item: item.serialize(), people))
+    cached = snapshot.serve_list("people")
+    if cached is not None:
+        return cached
+
+    fields = parse_fields(People.FIELDS)
+    rendered = dbjson.serve_list(People, "people", fields)
+    if rendered is not None:
+        return rendered
+
+    people = select_fields(People, fields) #solo las columnas pedidas en ?fields=
 
     #return jsonify(people), 200
 
@@ -240,34 +413,49 @@ def add_people():
     new_people = People(name=name, birthdate=birthdate, eyes=eyes, height=height)
 
     db.session.add(new_people)
+    stats.add_rows("people", [new_people.serialize()])
     db.session.commit()
+    snapshot.catalog_changed()
 
     return jsonify({"mensaje":"People creado correctamente"}), 201
 
 @app.route('/people/<int:id>', methods=['GET'])
+@read_only
+@single_flight
 def get_specific_people(id):
-    people = People.query.get(id)    
-  
-    return jsonify(people.serialize()), 200
+    cached = snapshot.serve_detail("people", id)
+    if cached is not None:
+        return cached
+
+    people = select_fields(People, parse_fields(People.FIELDS) + ("version",), People.id == id)
+    if not people:
+        raise APIException('personaje no encontrado', status_code=404)
+
+    return versioned(people[0])
 
 @app.route('/people-with-post', methods=['POST'])
+@read_only
 def get_specific_people_with_post():
     body = request.get_json()   
     id = body["id"]
 
-    people = People.query.get(id)   
-  
-    return jsonify(people.serialize()), 200
+    people = select_fields(People, parse_fields(People.FIELDS), People.id == id)
+    if not people:
+        raise APIException('personaje no encontrado', status_code=404)
+
+    return jsonify(people[0]), 200
 
 @app.route('/people', methods=['DELETE'])
 def delete_specific_people():
     body = request.get_json()   
     id = body["id"]
 
-    people = People.query.get(id)
+    deleted = delete_catalog_rows(People, FavoritePeople, People.id == id)
+    if deleted == 0:
+        raise APIException('personaje no encontrado', status_code=404)
 
-    db.session.delete(people)
     db.session.commit()  
+    snapshot.catalog_changed()
   
     return jsonify("People borrado"), 200
 
@@ -291,24 +479,31 @@ def edit_people():
     if "height" not in body:
         raise APIException("You need to specify the height", status_code=400)
 
-    people = People.query.get(id)   
-    people.name = name #modificamos el nombre en base de datos
-    people.birthdate = birthdate
-    people.eyes = eyes
-    people.height = height
+    people = conditional_update(People, id, {"name": name, "birthdate": birthdate, "eyes": eyes, "height": height}, "people", 'personaje no encontrado')
 
     db.session.commit()
+    snapshot.catalog_changed()
   
-    return jsonify(people.serialize()), 200
+    return versioned(people)
 
 ############################################################# PLANETS:
 ############################################################# PLANETS:
 ############################################################# PLANETS:
 
 @app.route('/planets', methods=['GET'])
+@read_only
+@single_flight
 def get_all_planets():
-    planets = Planets.query.all()
-    planets = list(map(lambda item: item.serialize(), planets))
+    cached = snapshot.serve_list("planets")
+    if cached is not None:
+        return cached
+
+    fields = parse_fields(Planets.FIELDS)
+    rendered = dbjson.serve_list(Planets, "planets", fields)
+    if rendered is not None:
+        return rendered
+
+    planets = select_fields(Planets, fields) #solo las columnas pedidas en ?fields=
 
     #return jsonify(people), 200
 
@@ -341,34 +536,49 @@ def add_planet():
     new_planet = Planets(name=name, population=population, surface=surface, diameter=diameter)
 
     db.session.add(new_planet)
+    stats.add_rows("planets", [new_planet.serialize()])
     db.session.commit()
+    snapshot.catalog_changed()
 
     return jsonify({"mensaje":"Planet creado correctamente"}), 201
 
 @app.route('/planets/<int:id>', methods=['GET'])
+@read_only
+@single_flight
 def get_specific_planet(id):
-    planet = Planets.query.get(id)    
-  
-    return jsonify(planet.serialize()), 200
+    cached = snapshot.serve_detail("planets", id)
+    if cached is not None:
+        return cached
+
+    planet = select_fields(Planets, parse_fields(Planets.FIELDS) + ("version",), Planets.id == id)
+    if not planet:
+        raise APIException('planeta no encontrado', status_code=404)
+
+    return versioned(planet[0])
 
 @app.route('/planet-with-post', methods=['POST'])
+@read_only
 def get_specific_planet_with_post():
     body = request.get_json()   
     id = body["id"]
 
-    planet = Planets.query.get(id)   
-  
-    return jsonify(planet.serialize()), 200
+    planet = select_fields(Planets, parse_fields(Planets.FIELDS), Planets.id == id)
+    if not planet:
+        raise APIException('planeta no encontrado', status_code=404)
+
+    return jsonify(planet[0]), 200
 
 @app.route('/planets', methods=['DELETE'])
 def delete_specific_planet():
     body = request.get_json()   
     id = body["id"]
 
-    planet = Planets.query.get(id) 
+    deleted = delete_catalog_rows(Planets, FavoritePlanets, Planets.id == id)
+    if deleted == 0:
+        raise APIException('planeta no encontrado', status_code=404)
 
-    db.session.delete(planet)
     db.session.commit()  
+    snapshot.catalog_changed()
   
     return jsonify("Planet borrado"), 200
 
@@ -392,24 +602,31 @@ def edit_planet():
     if "diameter" not in body:
         raise APIException("You need to specify the diameter", status_code=400)
 
-    planet = Planets.query.get(id)   
-    planet.name = name #modificamos el nombre en base de datos
-    planet.population = population
-    planet.surface = surface
-    planet.diameter = diameter
+    planet = conditional_update(Planets, id, {"name": name, "population": population, "surface": surface, "diameter": diameter}, "planets", 'planeta no encontrado')
 
     db.session.commit()
+    snapshot.catalog_changed()
   
-    return jsonify(planet.serialize()), 200
+    return versioned(planet)
 
 ############################################################# VEHICLES:
 ############################################################# VEHICLES:
 ############################################################# VEHICLES:
 
 @app.route('/vehicles', methods=['GET'])
+@read_only
+@single_flight
 def get_all_vehicles():
-    vehicles = Vehicles.query.all()
-    vehicles = list(map(lambda item: item.serialize(), vehicles))
+    cached = snapshot.serve_list("vehicles")
+    if cached is not None:
+        return cached
+
+    fields = parse_fields(Vehicles.FIELDS)
+    rendered = dbjson.serve_list(Vehicles, "vehicles", fields)
+    if rendered is not None:
+        return rendered
+
+    vehicles = select_fields(Vehicles, fields) #solo las columnas pedidas en ?fields=
 
     #return jsonify(people), 200
 
@@ -442,34 +659,49 @@ def add_vehicle():
     new_vehicle = Vehicles(name=name, passengers=passengers, length=length, cargo_capacity=cargo_capacity)
 
     db.session.add(new_vehicle)
+    stats.add_rows("vehicles", [new_vehicle.serialize()])
     db.session.commit()
+    snapshot.catalog_changed()
 
     return jsonify({"mensaje":"Vehicle creado correctamente"}), 201
 
 @app.route('/vehicles/<int:id>', methods=['GET'])
+@read_only
+@single_flight
 def get_specific_vehicle(id):
-    vehicle = Vehicles.query.get(id)    
-  
-    return jsonify(vehicle.serialize()), 200
+    cached = snapshot.serve_detail("vehicles", id)
+    if cached is not None:
+        return cached
+
+    vehicle = select_fields(Vehicles, parse_fields(Vehicles.FIELDS) + ("version",), Vehicles.id == id)
+    if not vehicle:
+        raise APIException('vehicle not found', status_code=404)
+
+    return versioned(vehicle[0])
 
 @app.route('/vehicles-with-post', methods=['POST'])
+@read_only
 def get_specific_vehicle_with_post():
     body = request.get_json()   
     id = body["id"]
 
-    vehicle = Vehicles.query.get(id)   
-  
-    return jsonify(vehicle.serialize()), 200
+    vehicle = select_fields(Vehicles, parse_fields(Vehicles.FIELDS), Vehicles.id == id)
+    if not vehicle:
+        raise APIException('vehicle not found', status_code=404)
+
+    return jsonify(vehicle[0]), 200
 
 @app.route('/vehicles', methods=['DELETE'])
 def delete_specific_vehicle():
     body = request.get_json()   
     id = body["id"]
 
-    vehicle = Vehicles.query.get(id) 
+    deleted = delete_catalog_rows(Vehicles, FavoriteVehicles, Vehicles.id == id)
+    if deleted == 0:
+        raise APIException('vehicle not found', status_code=404)
 
-    db.session.delete(vehicle)
     db.session.commit()  
+    snapshot.catalog_changed()
   
     return jsonify("Vehicle borrado"), 200
 
@@ -493,35 +725,197 @@ def edit_vehicle():
     if "cargo_capacity" not in body:
         raise APIException("You need to specify the cargo_capacity", status_code=400)
 
-    vehicle = Vehicles.query.get(id)   
-    vehicle.name = name #modificamos el nombre en base de datos
-    vehicle.passengers = passengers
-    vehicle.length = length
-    vehicle.cargo_capacity = cargo_capacity
+    vehicle = conditional_update(Vehicles, id, {"name": name, "passengers": passengers, "length": length, "cargo_capacity": cargo_capacity}, "vehicles", 'vehicle not found')
 
     db.session.commit()
+    snapshot.catalog_changed()
   
-    return jsonify(vehicle.serialize()), 200
+    return versioned(vehicle)
+
+############################################################# BULK DELETE:
+############################################################# BULK DELETE:
+############################################################# BULK DELETE:
+
+BULK_DELETE = {
+    "people": (People, FavoritePeople, ("name", "birthdate", "eyes", "height")),
+    "planets": (Planets, FavoritePlanets, ("name", "population", "surface", "diameter")),
+    "vehicles": (Vehicles, FavoriteVehicles, ("name", "passengers", "length", "cargo_capacity"))
+}
+
+def bulk_filters(kind, body):
+    model, favorite_model, columns = BULK_DELETE[kind]
+    filters = []
+    if "ids" in body:
+        ids = body["ids"]
+        if not isinstance(ids, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+            raise APIException("ids must be a list of integers", status_code=400)
+        filters.append(model.id.in_(ids))
+    for column in columns:
+        if column in body:
+            filters.append(getattr(model, column) == body[column])
+
+    #sin filtros borrariamos toda la tabla
+    if not filters:
+        raise APIException("You need to specify at least one filter: ids, " + ", ".join(columns), status_code=400)
+    return and_(*filters)
+
+@jobs.job("bulk-delete")
+def bulk_delete_job(ctx, kind, body):
+    model, favorite_model, columns = BULK_DELETE[kind]
+    deleted = delete_catalog_rows(model, favorite_model, bulk_filters(kind, body))
+    db.session.commit()
+    snapshot.catalog_changed()
+    return {"deleted": deleted}
+
+@app.route('/<kind>/bulk', methods=['DELETE'])
+def bulk_delete(kind):
+    if kind not in BULK_DELETE:
+        raise APIException('Unknown kind, use people, planets or vehicles', status_code=404)
+    body = request.get_json()
+    if body is None:
+        raise APIException("You need to specify the request body as json object", status_code=400)
+
+    condition = bulk_filters(kind, body)
+    if request.args.get("async") == "1":
+        #lo ejecuta `flask jobs-worker`, el progreso se consulta en /jobs/<id>
+        job = jobs.enqueue("bulk-delete", {"kind": kind, "body": body})
+        db.session.commit()
+        return jsonify({"msg": "queued", "job": job.id, "status_url": url_for("get_job", id=job.id)}), 202
+
+    model, favorite_model, columns = BULK_DELETE[kind]
+    deleted = delete_catalog_rows(model, favorite_model, condition)
+    db.session.commit()
+    snapshot.catalog_changed()
+
+    return jsonify({"msg": "ok", "deleted": deleted}), 200
+
+############################################################# PATCH:
+############################################################# PATCH:
+############################################################# PATCH:
+
+JSON_TYPES = {int: "number", float: "number", str: "string", bool: "boolean"} #nombre del tipo en los errores
+
+def check_value(model, field, value):
+    """400 si value no sirve para la columna field de model: null en una columna NOT NULL,
+    o un tipo JSON que no es el de la columna (la base de datos responderia con un 500)."""
+    column = model.__table__.c[field]
+    if value is None:
+        if not column.nullable:
+            raise APIException("%s can not be null" % field, status_code=400)
+        return
+
+    python_type = column.type.python_type
+    if python_type is float:
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif python_type is int:
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    else:
+        valid = isinstance(value, python_type)
+    if not valid:
+        raise APIException("%s must be a %s" % (field, JSON_TYPES.get(python_type, python_type.__name__)), status_code=400)
+
+    length = getattr(column.type, "length", None)
+    if length is not None and len(value) > length:
+        raise APIException("%s can have at most %d characters" % (field, length), status_code=400)
+
+def patch_values(body, model, columns):
+    """Los campos del body de un PATCH, solo columnas editables y con valores validos."""
+    if not isinstance(body, dict):
+        raise APIException("You need to specify the request body as json object", status_code=400)
+    unknown = sorted(set(body) - set(columns))
+    if unknown:
+        raise APIException("Unknown fields: " + ", ".join(unknown) + ". Editable fields: " + ", ".join(columns), status_code=400)
+    if not body:
+        raise APIException("You need to specify at least one field: " + ", ".join(columns), status_code=400)
+    for field, value in body.items():
+        check_value(model, field, value)
+    return body
+
+@app.route('/<kind>/<int:id>', methods=['PATCH'])
+def patch_catalog_row(kind, id):
+    if kind not in BULK_DELETE:
+        raise APIException('Unknown kind, use people, planets or vehicles', status_code=404)
+    model, favorite_model, columns = BULK_DELETE[kind]
+
+    #solo los campos enviados, con If-Match: "v<n>" (el ETag del GET) falla con 412 si alguien escribio antes
+    row = conditional_update(model, id, patch_values(request.get_json(), model, columns), kind, 'not found')
+    db.session.commit()
+    snapshot.catalog_changed()
+
+    return versioned(row)
 
 ############################################################# FAVORITES:
 ############################################################# FAVORITES:
 ############################################################# FAVORITES:
 
+FAVORITE_KINDS = (
+    (FavoritePeople, People, "/people"),
+    (FavoritePlanets, Planets, "/planets"),
+    (FavoriteVehicles, Vehicles, "/vehicles")
+)
+FAVORITE_FIELDS = ("id", "name", "url")
+FAVORITE_INCLUDES = ("user", "people", "planets", "vehicles")
+
+def newest(cursor, stamps):
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    if cursor is not None:
+        stamps.append(cursor)
+    return max(stamps, default=None)
+
+def serialize_favorites(user_id, fields=FAVORITE_FIELDS, include=(), since=None, until=None):
+    """Favoritos del usuario como {"id", "name", "url"}: una consulta por tabla de favoritos y
+    otra al catalogo solo si se piden los nombres o el objeto. Con since solo los cambiados
+    entre since y until (change_seq). Devuelve tambien el change_seq mas nuevo."""
+    all_favorites = []
+    last_change = None
+
+    for favorite_model, item_model, url in FAVORITE_KINDS:
+        kind = favorite_model.sync_kind
+        rows = queries.favorites_by_user(favorite_model, user_id, since, until)
+        if not rows:
+            continue
+
+        items = {}
+        if "name" in fields or kind in include:
+            item_fields = item_model.FIELDS if kind in include else ("id", "name")
+            items = {item["id"]: item for item in select_fields(item_model, item_fields, item_model.id.in_([row[0] for row in rows]))}
+
+        for item_id, change_seq in rows:
+            favorite = {}
+            if "id" in fields:
+                favorite["id"] = item_id
+            if "name" in fields:
+                favorite["name"] = items.get(item_id, {}).get("name")
+            if "url" in fields:
+                favorite["url"] = url
+            if kind in include:
+                favorite[kind] = items.get(item_id)
+            all_favorites.append(favorite)
+
+        last_change = newest(last_change, [row[1] for row in rows])
+
+    return all_favorites, last_change
+
+#consultas de rutas con token que el warmup no puede pedir por HTTP
+warmup.add_step("favorites", lambda: fan_out(lambda: serialize_favorites(0)))
+warmup.add_step("token version", lambda: token_versions.current(0))
+
 @app.route('/favorite/people', methods=['POST'])
 def add_favorite_people():
     body = request.get_json()
     user_id = body["user_id"]
     people_id = body["people_id"]
+    use_shard(user_id)
 
-    character = People.query.get(people_id)
+    character = queries.get_by_id(People, people_id)
     if not character:
         raise APIException('personaje no encontrado', status_code=404)
     
-    user = User.query.get(user_id)
+    user = queries.get_by_id(User, user_id)
     if not user:
         raise APIException('usuario no encontrado', status_code=404)
 
-    fav_exist = FavoritePeople.query.filter_by(user_id = user.id, people_id = character.id).first() is not None
+    fav_exist = queries.favorite(FavoritePeople, user.id, character.id) is not None
     
     if fav_exist:
         raise APIException('el usuario ya lo tiene agregado a favoritos', status_code=400)
@@ -529,10 +923,12 @@ def add_favorite_people():
     favorite_people = FavoritePeople(user_id=user.id, people_id=character.id)
     db.session.add(favorite_people)
     db.session.commit()
+    recommendations.favorite_added(user.id, "people", character.id)
+    audit.record("favorite_added", user.id, kind="people", item_id=character.id)
 
     return jsonify({
-        "people_name":favorite_people.serialize()["people_name"],
-        "user": favorite_people.serialize()["user_name"]
+        "people_name":character.name,
+        "user": user.name
     }), 201
 
 @app.route('/favorite/people', methods=['DELETE'])
@@ -540,14 +936,17 @@ def remove_favorite_people():
     body = request.get_json()
     user_id = body["user_id"]
     people_id = body["people_id"]
+    use_shard(user_id)
 
-    favorite_people = FavoritePeople.query.filter_by(user_id=user_id, people_id=people_id).first()
+    favorite_people = queries.favorite(FavoritePeople, user_id, people_id)
 
     if not favorite_people:
         raise APIException('Favorite people not found', status_code=404)
 
     db.session.delete(favorite_people)
     db.session.commit()
+    recommendations.favorite_removed(user_id, "people", people_id)
+    audit.record("favorite_removed", user_id, kind="people", item_id=people_id)
 
     return jsonify({"msg":"Favorite people removed successfully"}), 200
 
@@ -556,16 +955,17 @@ def add_favorite_planet():
     body = request.get_json()
     user_id = body["user_id"]
     planet_id = body["planet_id"]
+    use_shard(user_id)
 
-    planet = Planets.query.get(planet_id)
+    planet = queries.get_by_id(Planets, planet_id)
     if not planet:
         raise APIException('planeta no encontrado', status_code=404)
     
-    user = User.query.get(user_id)
+    user = queries.get_by_id(User, user_id)
     if not user:
         raise APIException('usuario no encontrado', status_code=404)
 
-    fav_exist = FavoritePlanets.query.filter_by(user_id = user.id, planet_id = planet.id).first() is not None
+    fav_exist = queries.favorite(FavoritePlanets, user.id, planet.id) is not None
     
     if fav_exist:
         raise APIException('el usuario ya lo tiene agregado a favoritos', status_code=400)
@@ -573,10 +973,12 @@ def add_favorite_planet():
     favorite_planet = FavoritePlanets(user_id=user.id, planet_id=planet.id)
     db.session.add(favorite_planet)
     db.session.commit()
+    recommendations.favorite_added(user.id, "planets", planet.id)
+    audit.record("favorite_added", user.id, kind="planets", item_id=planet.id)
 
     return jsonify({
-        "planet_name":favorite_planet.serialize()["planet_name"],
-        "user": favorite_planet.serialize()["user_name"]
+        "planet_name":planet.name,
+        "user": user.name
     }), 201
 
 @app.route('/favorite/planet', methods=['DELETE'])
@@ -584,14 +986,17 @@ def remove_favorite_planet():
     body = request.get_json()
     user_id = body["user_id"]
     planet_id = body["planet_id"]
+    use_shard(user_id)
 
-    favorite_planet = FavoritePlanets.query.filter_by(user_id=user_id, planet_id=planet_id).first()
+    favorite_planet = queries.favorite(FavoritePlanets, user_id, planet_id)
 
     if not favorite_planet:
         raise APIException('Favorite planet not found', status_code=404)
 
     db.session.delete(favorite_planet)
     db.session.commit()
+    recommendations.favorite_removed(user_id, "planets", planet_id)
+    audit.record("favorite_removed", user_id, kind="planets", item_id=planet_id)
 
     return jsonify({"msg":"Favorite planet removed successfully"}), 200
 
@@ -600,16 +1005,17 @@ def add_favorite_vehicle():
     body = request.get_json()
     user_id = body["user_id"]
     vehicle_id = body["vehicle_id"]
+    use_shard(user_id)
 
-    vehicle = Vehicles.query.get(vehicle_id)
+    vehicle = queries.get_by_id(Vehicles, vehicle_id)
     if not vehicle:
         raise APIException('vehicle not found', status_code=404)
 
-    user = User.query.get(user_id)
+    user = queries.get_by_id(User, user_id)
     if not user:
         raise APIException('user not found', status_code=404)
 
-    fav_exist = FavoriteVehicles.query.filter_by(user_id=user.id, vehicle_id=vehicle.id).first() is not None
+    fav_exist = queries.favorite(FavoriteVehicles, user.id, vehicle.id) is not None
 
     if fav_exist:
         raise APIException('user already has it added to favorites', status_code=400)
@@ -617,10 +1023,12 @@ def add_favorite_vehicle():
     favorite_vehicle = FavoriteVehicles(user_id=user.id, vehicle_id=vehicle.id)
     db.session.add(favorite_vehicle)
     db.session.commit()
+    recommendations.favorite_added(user.id, "vehicles", vehicle.id)
+    audit.record("favorite_added", user.id, kind="vehicles", item_id=vehicle.id)
 
     return jsonify({
-        "vehicle_name": favorite_vehicle.serialize()["vehicle_name"],
-        "user": favorite_vehicle.serialize()["user_name"]
+        "vehicle_name": vehicle.name,
+        "user": user.name
     }), 201
 
 
@@ -629,18 +1037,22 @@ def remove_favorite_vehicle():
     body = request.get_json()
     user_id = body["user_id"]
     vehicle_id = body["vehicle_id"]
+    use_shard(user_id)
 
-    favorite_vehicle = FavoriteVehicles.query.filter_by(user_id=user_id, vehicle_id=vehicle_id).first()
+    favorite_vehicle = queries.favorite(FavoriteVehicles, user_id, vehicle_id)
 
     if not favorite_vehicle:
         raise APIException('Favorite vehicle not found', status_code=404)
 
     db.session.delete(favorite_vehicle)
     db.session.commit()
+    recommendations.favorite_removed(user_id, "vehicles", vehicle_id)
+    audit.record("favorite_removed", user_id, kind="vehicles", item_id=vehicle_id)
 
     return jsonify({"msg": "Favorite vehicle removed successfully"}), 200
 
 @app.route('/favorites', methods=['POST'])
+@read_only
 def get_favorites_with_post():
     body = request.get_json()
     user_id = body["user_id"]
@@ -648,44 +1060,150 @@ def get_favorites_with_post():
     if user_id is None:
         raise APIException("You need to specify the user_id as a query parameter", status_code=400)
 
-    user = User.query.get(user_id)
+    use_shard(user_id)
+
+    user = queries.get_by_id(User, user_id)
     if not user:
         raise APIException('User not found', status_code=404)
 
-    favorite_people = list(map(lambda item: {"name": item.serialize()["people_name"], "id": item.serialize()["people_id"], "url": "/people"}, FavoritePeople.query.filter_by(user_id=user.id)))
-    favorite_planets = list(map(lambda item: {"name": item.serialize()["planet_name"], "id": item.serialize()["planet_id"], "url": "/planets"}, FavoritePlanets.query.filter_by(user_id=user.id)))
-    favorite_vehicles = list(map(lambda item: {"name": item.serialize()["vehicle_name"], "id": item.serialize()["vehicle_id"], "url": "/vehicles"}, FavoriteVehicles.query.filter_by(user_id=user.id)))
+    include = parse_include(FAVORITE_INCLUDES)
+    fields = parse_fields(FAVORITE_FIELDS)
+    rendered = dbjson.serve_favorites(user.id, FAVORITE_KINDS, fields, include, **({"user": user.serialize()} if "user" in include else {}))
+    if rendered is not None:
+        return rendered
 
-    return jsonify({
+    all_favorites, _ = serialize_favorites(user.id, fields, include)
+
+    response_body = {
         "msg":"ok",
-        "all_favorites": favorite_people + favorite_planets + favorite_vehicles,
-    }), 200
+        "all_favorites": all_favorites,
+    }
+    if "user" in include:
+        response_body["user"] = user.serialize()
+
+    return jsonify(response_body), 200
 
 @app.route('/favorites/<int:user_id>', methods=['GET'])
 @jwt_required()
+@read_only
+@single_flight
 def get_favorites(user_id):
     current_user = get_jwt_identity() # Get the current user ID from the token
     if user_id != current_user: # Check if the requested user ID matches the current user ID
         raise APIException('Unauthorized', status_code=401)
-    
-    user = User.query.get(user_id)
-    if not user:
-        raise APIException('User not found', status_code=404)
+
+    #el usuario existe: si no, su token_version no valida el token
+    user = user_from_claims(get_jwt())
+
+    use_shard(user_id)
 
     token = verificacionToken(get_jwt()["jti"])
     if token:
        raise APIException('Token está en lista negra', status_code=404)
 
-    favorite_people = list(map(lambda item: {"name": item.serialize()["people_name"], "id": item.serialize()["people_id"], "url": "/people"}, FavoritePeople.query.filter_by(user_id=current_user)))
-    favorite_planets = list(map(lambda item: {"name": item.serialize()["planet_name"], "id": item.serialize()["planet_id"], "url": "/planets"}, FavoritePlanets.query.filter_by(user_id=current_user)))
-    favorite_vehicles = list(map(lambda item: {"name": item.serialize()["vehicle_name"], "id": item.serialize()["vehicle_id"], "url": "/vehicles"}, FavoriteVehicles.query.filter_by(user_id=current_user)))
+    include = parse_include(FAVORITE_INCLUDES)
+    fields = parse_fields(FAVORITE_FIELDS)
+    rendered = dbjson.serve_favorites(current_user, FAVORITE_KINDS, fields, include, **({"user": user} if "user" in include else {}))
+    if rendered is not None:
+        return rendered
+
+    all_favorites, _ = serialize_favorites(current_user, fields, include)
+
+    response_body = {
+        "msg":"ok",
+        "all_favorites": all_favorites,
+    }
+    if "user" in include:
+        response_body["user"] = user
+
+    return jsonify(response_body), 200
+
+
+@app.route('/favorites/report', methods=['GET'])
+@read_only
+@single_flight
+def get_favorites_report():
+    #cuenta los favoritos de todos los shards en paralelo
+    def count_favorites():
+        return {
+            "people": FavoritePeople.query.count(),
+            "planets": FavoritePlanets.query.count(),
+            "vehicles": FavoriteVehicles.query.count()
+        }
+
+    per_shard = fan_out(count_favorites)
+    totals = {kind: sum(counts[kind] for counts in per_shard) for kind in ("people", "planets", "vehicles")}
 
     return jsonify({
         "msg":"ok",
-        "all_favorites": favorite_people + favorite_planets + favorite_vehicles,
+        "totals": totals,
+        "shards": per_shard
     }), 200
 
+############################################################# CHANGES:
+############################################################# CHANGES:
+############################################################# CHANGES:
+
+@app.route('/changes', methods=['GET'])
+@jwt_required(optional=True)
+@read_only
+@single_flight
+def get_changes():
+    #cursor "<catalogo>:<favoritos>", cada parte el ultimo change_seq ya enviado; sin token solo "<catalogo>"
+    since = request.args.get("since")
+    since_catalog = since_favorites = None
+    if since:
+        parts = since.split(":")
+        if len(parts) > 2 or not all(part.isdigit() for part in parts):
+            raise APIException("since must be a cursor returned by /changes", status_code=400)
+        since_catalog = int(parts[0])
+        since_favorites = int(parts[1]) if len(parts) == 2 else None
+
+    #el contador se lee antes que las filas: todo change_seq <= until ya hizo commit
+    until_catalog = db.session.execute(select(CatalogChangeCounter.value)).scalar() or 0
+    response_body = {"msg": "ok"}
+
+    for kind, model in (("people", People), ("planets", Planets), ("vehicles", Vehicles)):
+        rows = model.query
+        deleted = Tombstone.query.filter_by(kind=kind)
+        if since_catalog is not None:
+            rows = rows.filter(model.change_seq > since_catalog, model.change_seq <= until_catalog)
+            deleted = deleted.filter(Tombstone.change_seq > since_catalog, Tombstone.change_seq <= until_catalog)
+        rows = rows.all()
+        deleted = deleted.all()
+
+        response_body[kind] = {
+            "upserted": list(map(lambda item: item.serialize(), rows)),
+            "deleted": sorted({row.row_id for row in deleted})
+        }
+
+    cursor = str(until_catalog)
+
+    #los favoritos solo si viene el token del usuario
+    current_user = get_jwt_identity()
+    if current_user is not None:
+        use_shard(current_user)
+        until_favorites = db.session.execute(
+            select(FavoriteChangeCounter.value).where(FavoriteChangeCounter.user_id == current_user)
+        ).scalar() or 0
+        upserted, _ = serialize_favorites(current_user, since=since_favorites, until=until_favorites)
+
+        deleted = FavoriteTombstone.query.filter_by(user_id=current_user)
+        if since_favorites is not None:
+            deleted = deleted.filter(FavoriteTombstone.change_seq > since_favorites, FavoriteTombstone.change_seq <= until_favorites)
+        deleted = deleted.all()
+
+        response_body["favorites"] = {
+            "upserted": upserted,
+            "deleted": [{"id": row.item_id, "url": "/" + row.kind} for row in deleted]
+        }
+        cursor += ":%d" % until_favorites
+    elif since_favorites is not None:
+        cursor += ":%d" % since_favorites #sin token los favoritos no avanzan
+
+    response_body["cursor"] = cursor
 
+    return jsonify(response_body), 200
 
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
@@ -0,0 +1,186 @@
+"""
+Audit log of logins, logouts and favorite changes without a database write in the request.
+Handlers call record(), which puts the event in a bounded in-process queue; a writer thread
+per process takes up to AUDIT_BATCH_SIZE events, or whatever arrived within AUDIT_FLUSH_MS
+of the first one, and inserts them in one executemany (multi-row INSERT with psycopg2). With
+the queue full a request waits up to AUDIT_BLOCK_MS for room and then the event is dropped
+and counted. At exit the queue is flushed before the process ends. GET /internal/audit
+queries the table.
+"""
+import os
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+from flask import jsonify, request, current_app, has_request_context
+from sqlalchemy import select
+
+from models import db, utcnow, AuditLog
+from utils import APIException, internal_only
+
+QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", 10000))
+BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_MS", 200)) / 1000
+BLOCK_SECONDS = float(os.getenv("AUDIT_BLOCK_MS", 50)) / 1000
+RETRIES = 3
+
+_STOP = object()
+
+class AuditWriter:
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._engine = None
+        self._logger = None
+        self.written = 0
+        self.dropped = 0 # cola llena o lote que fallo RETRIES veces
+
+    def _ensure_started(self):
+        # un thread por proceso: gunicorn hace fork despues de importar la app
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+            self._engine = db.engine # el primario, los favoritos pueden estar en shards pero la auditoria no
+            self._logger = current_app.logger
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def record(self, event, user_id=None, email=None, kind=None, item_id=None):
+        """Queue an event, call it after the commit of the change it describes."""
+        self._ensure_started()
+        row = {
+            "event": event,
+            "user_id": user_id,
+            "email": email,
+            "kind": kind,
+            "item_id": item_id,
+            "ip": request.remote_addr if has_request_context() else None,
+            "created_at": utcnow()
+        }
+        try:
+            self._queue.put(row, timeout=BLOCK_SECONDS)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _next_batch(self):
+        """Up to BATCH_SIZE events, waiting at most FLUSH_SECONDS after the first one.
+        The second value is True when the writer has to stop after this batch."""
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + FLUSH_SECONDS
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                row = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if row is _STOP:
+                return batch, True
+            batch.append(row)
+        return batch, False
+
+    def _write(self, batch):
+        for attempt in range(RETRIES):
+            try:
+                with self._engine.begin() as connection:
+                    connection.execute(AuditLog.__table__.insert(), batch)
+            except Exception:
+                self._logger.exception("audit batch of %d events failed, attempt %d/%d", len(batch), attempt + 1, RETRIES)
+                time.sleep(0.1 * 2 ** attempt)
+            else:
+                with self._lock:
+                    self.written += len(batch)
+                return
+        with self._lock:
+            self.dropped += len(batch)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._write(batch)
+
+        # lo que quedo en la cola despues de stop()
+        rest = []
+        while True:
+            try:
+                rest.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        rest = [row for row in rest if row is not _STOP]
+        for start in range(0, len(rest), BATCH_SIZE):
+            self._write(rest[start:start + BATCH_SIZE])
+
+    def stop(self, timeout=10):
+        """Write everything queued so far and stop the writer of this process."""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP) # sin timeout: el writer siempre vacia la cola
+        self._thread.join(timeout)
+        self._pid = None
+
+    def report(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize() if self._pid == os.getpid() else 0,
+                "written": self.written,
+                "dropped": self.dropped
+            }
+
+audit_writer = AuditWriter()
+
+def record(event, user_id=None, email=None, kind=None, item_id=None):
+    audit_writer.record(event, user_id, email, kind, item_id)
+
+def _parse_time(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise APIException("%s must be an ISO 8601 date" % name, status_code=400)
+
+def setup_audit(app):
+
+    @app.route('/internal/audit', methods=['GET'])
+    @internal_only
+    def get_audit_log():
+        criteria = []
+        for name in ("user_id", "item_id"):
+            if request.args.get(name):
+                if not request.args[name].isdigit():
+                    raise APIException("%s must be a number" % name, status_code=400)
+                criteria.append(getattr(AuditLog, name) == int(request.args[name]))
+        for name in ("event", "kind", "email"):
+            if request.args.get(name):
+                criteria.append(getattr(AuditLog, name) == request.args[name])
+        since, until = _parse_time("since"), _parse_time("until")
+        if since is not None:
+            criteria.append(AuditLog.created_at >= since)
+        if until is not None:
+            criteria.append(AuditLog.created_at < until)
+        limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+
+        statement = select(*[getattr(AuditLog, field) for field in AuditLog.FIELDS]).where(*criteria) \
+            .order_by(AuditLog.created_at.desc(), AuditLog.id.desc()).limit(limit)
+        events = [dict(row) for row in db.session.execute(statement).mappings()]
+
+        return jsonify({"msg": "ok", "events": events, "writer": audit_writer.report()}), 200
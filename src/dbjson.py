@@ -0,0 +1,168 @@
+"""
+JSON rendered by the database. With ?render=db (or DB_JSON_RENDER=1 for every request) the
+catalog lists and the favorites of a user are built as one JSON array by the database,
+json_group_array / json_object on SQLite and json_agg / json_build_object on Postgres, and
+that text goes into the response as is: no rows, dicts or json.dumps in Python. msgpack
+clients, sharded favorites (the catalog is in another database) and other databases keep
+using the usual path.
+"""
+import os
+import json
+import time
+
+import click
+from flask import request, current_app
+from sqlalchemy import select, insert, func, case, cast, null, union_all, literal_column, Text
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from models import db, select_fields, User, People, Planets, Vehicles, FavoritePeople, FavoritePlanets, FavoriteVehicles
+from negotiation import wants_msgpack
+from sharding import shards
+
+DIALECTS = ("sqlite", "postgresql")
+DEFAULT = os.getenv("DB_JSON_RENDER") == "1"
+
+def enabled():
+    """True when this request asks for the database-rendered JSON and the database can do it."""
+    render = request.args.get("render")
+    wanted = render == "db" if render else DEFAULT
+    return wanted and not wants_msgpack() and db.engine.dialect.name in DIALECTS
+
+def _constant(value):
+    # claves y urls son nuestras; en Postgres json_build_object no acepta parametros sin tipo
+    return literal_column("'%s'" % value.replace("'", "''"))
+
+def json_object(pairs):
+    """JSON object from [(key, column)], with the keys sorted like jsonify."""
+    arguments = []
+    for key, column in sorted(pairs, key=lambda pair: pair[0]):
+        arguments.extend((_constant(key), column))
+    if db.engine.dialect.name == "postgresql":
+        return func.json_build_object(*arguments)
+    return func.json_object(*arguments)
+
+def json_array(rows, *order_by):
+    """Select of the JSON array (as text) of rows.c.document, in the order of the order_by
+    columns of rows."""
+    order_by = [rows.c[name] for name in order_by]
+    if db.engine.dialect.name == "postgresql":
+        array = func.json_agg(aggregate_order_by(rows.c.document, *order_by))
+        return select(func.coalesce(cast(array, Text), "[]"))
+
+    # SQLite agrega en el orden de la subconsulta; json() porque el subtipo JSON de
+    # json_object se pierde al salir de ella y quedaria como string
+    ordered = select(rows.c.document).order_by(*order_by).subquery()
+    return select(func.json_group_array(func.json(ordered.c.document)))
+
+def list_array(model, fields):
+    """JSON array of the requested fields of every row of model, ordered by id."""
+    document = json_object([(field, getattr(model, field)) for field in fields])
+    rows = select(document.label("document"), model.id.label("row_id")).subquery()
+    return db.session.execute(json_array(rows, "row_id")).scalar_one()
+
+def favorites_array(user_id, kinds, fields, include):
+    """JSON array with the favorites of user_id, the same documents and order as
+    serialize_favorites(): kinds is [(favorite model, catalog model, url)]."""
+    parts = []
+    for position, (favorite_model, item_model, url) in enumerate(kinds):
+        kind = favorite_model.sync_kind
+        item_id = getattr(favorite_model, favorite_model.item_column)
+        pairs = []
+        if "id" in fields:
+            pairs.append(("id", item_id))
+        if "name" in fields:
+            pairs.append(("name", item_model.name))
+        if "url" in fields:
+            pairs.append(("url", _constant(url)))
+        if kind in include:
+            item = json_object([(field, getattr(item_model, field)) for field in item_model.FIELDS])
+            pairs.append((kind, case((item_model.id.is_(None), null()), else_=item)))
+
+        part = select(
+            json_object(pairs).label("document"),
+            literal_column(str(position)).label("kind_position"),
+            favorite_model.id.label("favorite_id")
+        ).where(favorite_model.user_id == user_id)
+        if "name" in fields or kind in include:
+            part = part.select_from(favorite_model).outerjoin(item_model, item_model.id == item_id)
+        parts.append(part)
+
+    rows = union_all(*parts).subquery()
+    return db.session.execute(json_array(rows, "kind_position", "favorite_id")).scalar_one()
+
+def document(key, array, **others):
+    """Body of {key: array, **others} with the keys sorted, array is JSON text."""
+    members = [(key, array.encode("utf-8"))]
+    for name, value in others.items():
+        members.append((name, json.dumps(value, separators=(",", ":"), sort_keys=True, default=current_app.json.default).encode("utf-8")))
+    return b"{" + b",".join(b'"' + name.encode("ascii") + b'":' + value for name, value in sorted(members)) + b"}\n"
+
+def _response(body):
+    response = current_app.response_class(body, status=200, mimetype="application/json")
+    response.vary.add("Accept")
+    return response
+
+def serve_list(model, kind, fields):
+    """Response for GET /<kind> rendered by the database, None to use the usual path."""
+    if not enabled():
+        return None
+    return _response(document(kind, list_array(model, fields), msg="ok"))
+
+def serve_favorites(user_id, kinds, fields, include, **others):
+    """Response for the favorites of user_id rendered by the database, None to use the
+    usual path. others go next to all_favorites, e.g. user."""
+    if not enabled() or shards.keys:
+        return None
+    return _response(document("all_favorites", favorites_array(user_id, kinds, fields, include), msg="ok", **others))
+
+def _timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+def setup_db_json(app):
+
+    @app.cli.command("bench-db-json")
+    @click.option("--rows", default=100000, show_default=True, help="Rows inserted in each catalog table for the benchmark.")
+    @click.option("--favorites", default=1000, show_default=True, help="Favorites per kind of the benchmark user.")
+    @click.option("--repeat", default=5, show_default=True, help="Runs of each path.")
+    def bench_db_json(rows, favorites, repeat):
+        """Compare the ORM + json.dumps path with the database-rendered JSON. The rows are
+        inserted in a transaction that is rolled back at the end."""
+        if db.engine.dialect.name not in DIALECTS:
+            raise click.ClickException("database-rendered JSON needs SQLite or Postgres")
+
+        samples = {
+            People: {"name": "Luke Skywalker", "birthdate": "19BBY", "eyes": "blue", "height": 1.72},
+            Planets: {"name": "Tatooine", "population": "200000", "surface": "1", "diameter": "10465"},
+            Vehicles: {"name": "Sand Crawler", "passengers": "30", "length": "36.8", "cargo_capacity": "50000"}
+        }
+        try:
+            for model, sample in samples.items():
+                db.session.execute(insert(model), [dict(sample, name="%s %d" % (sample["name"], index)) for index in range(rows)])
+            user = User(email="bench-db-json@example.com", password="-", is_active=False, name="bench")
+            db.session.add(user)
+            db.session.flush()
+            with_favorites = not shards.keys # con shards los favoritos estan en otra base de datos
+            if with_favorites:
+                for favorite_model, item_model in ((FavoritePeople, People), (FavoritePlanets, Planets), (FavoriteVehicles, Vehicles)):
+                    ids = db.session.execute(select(item_model.id).order_by(item_model.id.desc()).limit(favorites)).scalars().all()
+                    db.session.execute(insert(favorite_model), [{"user_id": user.id, favorite_model.item_column: item_id} for item_id in ids])
+
+            with app.test_request_context():
+                click.echo("%d rows per catalog table, mean of %d runs" % (rows, repeat))
+                click.echo("%-10s %12s %12s %12s" % ("endpoint", "orm_ms", "db_ms", "bytes"))
+                for model, kind in ((People, "people"), (Planets, "planets"), (Vehicles, "vehicles")):
+                    orm, orm_ms = _timed(lambda: current_app.json.response({"msg": "ok", kind: select_fields(model, model.FIELDS)}).get_data(), repeat)
+                    rendered, db_ms = _timed(lambda: document(kind, list_array(model, model.FIELDS), msg="ok"), repeat)
+                    click.echo("%-10s %12.1f %12.1f %12d" % (kind, orm_ms, db_ms, len(rendered)))
+
+                if with_favorites:
+                    from app import FAVORITE_KINDS, serialize_favorites
+                    fields, include = ("id", "name", "url"), ("people", "planets", "vehicles")
+                    orm, orm_ms = _timed(lambda: current_app.json.response({"msg": "ok", "all_favorites": serialize_favorites(user.id, fields, include)[0]}).get_data(), repeat)
+                    rendered, db_ms = _timed(lambda: document("all_favorites", favorites_array(user.id, FAVORITE_KINDS, fields, include), msg="ok"), repeat)
+                    click.echo("%-10s %12.1f %12.1f %12d" % ("favorites", orm_ms, db_ms, len(rendered)))
+        finally:
+            db.session.rollback()
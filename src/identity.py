@@ -0,0 +1,61 @@
+"""
+Identity claims carried in the access token, so the protected routes know the email and
+name of the user without loading it. Each user has a token_version: tokens carry it in
+"tv" and stop being accepted once it is incremented (log out everywhere). The current
+version is cached per worker for TOKEN_VERSION_TTL seconds.
+"""
+import os
+import time
+import threading
+
+from sqlalchemy import select, update
+
+from models import db, User
+
+CLAIMS_VERSION = 1 # subir si cambia el contenido de los claims, los tokens viejos dejan de valer
+
+class TokenVersions:
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._cache = {} # user_id -> (token_version o None si no existe, expira)
+        self._lock = threading.Lock()
+
+    def current(self, user_id):
+        cached = self._cache.get(user_id)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        version = db.session.execute(select(User.token_version).where(User.id == user_id)).scalar()
+        with self._lock:
+            self._cache[user_id] = (version, time.monotonic() + self.ttl)
+        return version
+
+    def bump(self, user_id):
+        """Invalidate every token of user_id issued so far, the caller commits."""
+        db.session.execute(update(User).where(User.id == user_id).values(token_version=User.token_version + 1))
+        self.forget(user_id)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+token_versions = TokenVersions(float(os.getenv("TOKEN_VERSION_TTL", 30)))
+
+def identity_claims(user):
+    """additional_claims for create_access_token."""
+    return {"cv": CLAIMS_VERSION, "tv": user.token_version, "email": user.email, "name": user.name}
+
+def user_from_claims(claims):
+    """Same dict as User.serialize(), built from the token."""
+    return {"id": claims["sub"], "email": claims["email"], "name": claims["name"]}
+
+def setup_identity(jwt):
+
+    @jwt.token_in_blocklist_loader
+    def stale_identity(jwt_header, jwt_payload):
+        # tokens sin claims o de otra version, usuario borrado o logout-all posterior al token
+        if jwt_payload.get("cv") != CLAIMS_VERSION:
+            return True
+        version = token_versions.current(jwt_payload["sub"])
+        return version is None or version != jwt_payload.get("tv")
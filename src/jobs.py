@@ -0,0 +1,263 @@
+"""
+Background jobs stored in the job table, no broker needed. The API enqueues rows and
+`flask jobs-worker` (a separate process, as many as wanted) claims them with a conditional
+UPDATE, runs them on a thread pool, retries failures with exponential backoff and enqueues
+the recurring maintenance jobs.
+"""
+import os
+import json
+import time
+import signal
+import socket
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import jsonify, request, current_app
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from models import db, utcnow, Job, TokenBlockedList
+from utils import APIException, internal_only
+
+RETRY_SECONDS = float(os.getenv("JOBS_RETRY_SECONDS", 30))
+STALE_SECONDS = float(os.getenv("JOBS_STALE_SECONDS", 300))
+
+registry = {}
+recurring = []
+
+def job(name, max_attempts=3):
+    """Register fn(ctx, **args) as the job called name."""
+    def decorator(fn):
+        registry[name] = (fn, max_attempts)
+        return fn
+    return decorator
+
+def every(seconds, name, args=None):
+    """Enqueue name every seconds (from the worker), seconds=0 disables it."""
+    if seconds > 0:
+        recurring.append((seconds, name, args or {}))
+
+def enqueue(name, args=None, run_at=None, unique_key=None):
+    """Add a job, the caller commits. Returns the Job."""
+    if name not in registry:
+        raise KeyError("Unknown job %s" % name)
+    new_job = Job(name=name, args=json.dumps(args or {}), run_at=run_at or utcnow(),
+                  unique_key=unique_key, max_attempts=registry[name][1])
+    db.session.add(new_job)
+    return new_job
+
+class JobContext:
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def progress(self, fraction, message=None):
+        """Save the progress right away, on its own connection, so /jobs sees it during the job."""
+        with db.engine.begin() as connection:
+            connection.execute(update(Job).where(Job.id == self.job_id).values(
+                progress=max(0.0, min(1.0, fraction)), message=message, heartbeat_at=utcnow()
+            ))
+
+def _backoff(attempts):
+    return timedelta(seconds=RETRY_SECONDS * 2 ** (attempts - 1))
+
+def run_job(job_id):
+    """Run a claimed job, it ends done, queued again for a retry or failed."""
+    claimed = db.session.get(Job, job_id)
+    name, args, attempts, max_attempts = claimed.name, json.loads(claimed.args), claimed.attempts, claimed.max_attempts
+    db.session.commit()
+
+    try:
+        fn = registry[name][0]
+        result = fn(JobContext(job_id), **args)
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        current_app.logger.exception("job %s (%s) failed, attempt %d/%d", job_id, name, attempts, max_attempts)
+        values = {"error": "%s: %s" % (type(error).__name__, error), "locked_by": None}
+        if attempts < max_attempts:
+            values.update(status="queued", run_at=utcnow() + _backoff(attempts))
+        else:
+            values.update(status="failed", finished_at=utcnow())
+        db.session.execute(update(Job).where(Job.id == job_id).values(**values))
+        db.session.commit()
+        return
+
+    db.session.execute(update(Job).where(Job.id == job_id).values(
+        status="done", progress=1.0, result=json.dumps(result), error=None, locked_by=None, finished_at=utcnow()
+    ))
+    db.session.commit()
+
+def claim(worker_id, limit):
+    """Ids of up to limit due jobs now owned by worker_id. The UPDATE only matches while the
+    job is still queued, so two workers never get the same job (no SELECT FOR UPDATE needed)."""
+    now = utcnow()
+    candidates = db.session.execute(
+        select(Job.id).where(Job.status == "queued", Job.run_at <= now).order_by(Job.run_at, Job.id).limit(limit * 2)
+    ).scalars().all()
+
+    claimed = []
+    for job_id in candidates:
+        result = db.session.execute(update(Job).where(Job.id == job_id, Job.status == "queued").values(
+            status="running", locked_by=worker_id, attempts=Job.attempts + 1, started_at=now, heartbeat_at=now
+        ))
+        db.session.commit()
+        if result.rowcount == 1:
+            claimed.append(job_id)
+            if len(claimed) == limit:
+                break
+    return claimed
+
+def requeue_stale():
+    """Jobs of a worker that died: running without a heartbeat for STALE_SECONDS. They go back
+    to the queue while they have attempts left, otherwise they fail (a job that kills its
+    worker would be retried forever)."""
+    limit = utcnow() - timedelta(seconds=STALE_SECONDS)
+    stale = [Job.status == "running", Job.heartbeat_at < limit]
+    requeued = db.session.execute(update(Job).where(*stale, Job.attempts < Job.max_attempts).values(
+        status="queued", locked_by=None, error="worker lost"
+    ))
+    failed = db.session.execute(update(Job).where(*stale, Job.attempts >= Job.max_attempts).values(
+        status="failed", locked_by=None, error="worker lost", finished_at=utcnow()
+    ))
+    db.session.commit()
+    return requeued.rowcount + failed.rowcount
+
+def schedule_recurring():
+    """Enqueue the recurring jobs whose period started, the unique key (name + period number)
+    keeps several workers from enqueueing the same one."""
+    now = time.time()
+    for seconds, name, args in recurring:
+        unique_key = "%s:%d" % (name, now // seconds)
+        try:
+            enqueue(name, args, unique_key=unique_key)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+def run_worker(app, concurrency, poll):
+    worker_id = "%s:%d" % (socket.gethostname(), os.getpid())
+    stopping = threading.Event()
+    running = set()
+    lock = threading.Lock()
+
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def work(job_id):
+        with app.app_context():
+            try:
+                run_job(job_id)
+            finally:
+                db.session.remove()
+                with lock:
+                    running.discard(job_id)
+
+    click.echo("worker %s: %d threads, jobs: %s" % (worker_id, concurrency, ", ".join(sorted(registry))))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while not stopping.is_set():
+            with app.app_context():
+                schedule_recurring()
+                requeue_stale()
+                with lock:
+                    busy = list(running)
+                if busy:
+                    db.session.execute(update(Job).where(Job.id.in_(busy), Job.locked_by == worker_id).values(heartbeat_at=utcnow()))
+                    db.session.commit()
+
+                free = concurrency - len(busy)
+                claimed = claim(worker_id, free) if free > 0 else []
+                db.session.remove()
+
+            for job_id in claimed:
+                with lock:
+                    running.add(job_id)
+                executor.submit(work, job_id)
+            if not claimed:
+                stopping.wait(poll)
+        click.echo("worker %s: stopping, waiting for %d running jobs" % (worker_id, len(running)))
+
+############################################################# BUILT-IN JOBS:
+
+@job("purge-token-blocklist")
+def purge_token_blocklist(ctx):
+    """Blocked tokens only matter until they expire."""
+    expires = current_app.config.get("JWT_ACCESS_TOKEN_EXPIRES", timedelta(minutes=15))
+    if not expires:
+        return {"deleted": 0}
+    if not isinstance(expires, timedelta):
+        expires = timedelta(seconds=expires)
+    result = db.session.execute(delete(TokenBlockedList).where(TokenBlockedList.created_at < utcnow() - expires))
+    return {"deleted": result.rowcount}
+
+@job("stats-rebuild")
+def stats_rebuild(ctx, kinds=None):
+    import stats
+    kinds = kinds or list(stats.METRICS)
+    totals = {}
+    for position, kind in enumerate(kinds):
+        totals[kind] = stats.rebuild(kind)
+        db.session.commit() # cada kind por separado, asi el progreso no espera a la transaccion
+        ctx.progress((position + 1) / len(kinds), kind)
+    return totals
+
+@job("snapshot-rebuild")
+def snapshot_rebuild(ctx):
+    from snapshot import catalog_snapshot
+    if catalog_snapshot.enabled:
+        catalog_snapshot.rebuild()
+    return {"enabled": catalog_snapshot.enabled}
+
+def setup_jobs(app):
+    every(float(os.getenv("JOBS_BLOCKLIST_PURGE_SECONDS", 3600)), "purge-token-blocklist")
+    every(float(os.getenv("JOBS_STATS_REBUILD_SECONDS", 86400)), "stats-rebuild")
+
+    @app.route('/jobs/<int:id>', methods=['GET'])
+    def get_job(id):
+        found = db.session.get(Job, id)
+        if found is None:
+            raise APIException('job no encontrado', status_code=404)
+        return jsonify(found.serialize()), 200
+
+    @app.route('/internal/jobs', methods=['GET'])
+    @internal_only
+    def get_jobs():
+        query = select(Job).order_by(Job.id.desc()).limit(max(1, min(request.args.get("limit", 50, type=int), 500)))
+        if "status" in request.args:
+            query = query.where(Job.status == request.args["status"])
+        found = db.session.execute(query).scalars().all()
+        return jsonify({"msg": "ok", "jobs": [item.serialize() for item in found]}), 200
+
+    @app.route('/internal/jobs', methods=['POST'])
+    @internal_only
+    def post_job():
+        body = request.get_json()
+        if body is None or "name" not in body:
+            raise APIException("You need to specify the job name", status_code=400)
+        if body["name"] not in registry:
+            raise APIException("Unknown job, use " + ", ".join(sorted(registry)), status_code=400)
+        new_job = enqueue(body["name"], body.get("args"))
+        db.session.commit()
+        return jsonify(new_job.serialize()), 202
+
+    @app.cli.command("jobs-worker")
+    @click.option("--concurrency", default=4, show_default=True, help="Jobs run at the same time.")
+    @click.option("--poll", default=1.0, show_default=True, help="Seconds between polls when the queue is empty.")
+    def jobs_worker(concurrency, poll):
+        """Run queued and recurring background jobs until SIGTERM."""
+        run_worker(current_app._get_current_object(), concurrency, poll)
+
+    @app.cli.command("jobs-enqueue")
+    @click.argument("name")
+    @click.option("--args", "args", default="{}", help="Job arguments as JSON.")
+    def jobs_enqueue(name, args):
+        """Enqueue a job by name."""
+        if name not in registry:
+            raise click.ClickException("Unknown job, use " + ", ".join(sorted(registry)))
+        new_job = enqueue(name, json.loads(args))
+        db.session.commit()
+        click.echo("job %d queued" % new_job.id)
@@ -1,6 +1,29 @@
+import sqlite3
+from datetime import datetime, timezone
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, select, update, insert, literal
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import object_session
+from routing import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def select_fields(model, fields, *criteria):
+    """Only the requested columns of the rows matching criteria, as dicts, without ORM objects."""
+    statement = select(*[getattr(model, field) for field in fields]).where(*criteria).order_by(model.id)
+    return [dict(row) for row in db.session.execute(statement).mappings()]
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite no aplica ON DELETE CASCADE si no se activa en cada conexion
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -8,20 +31,22 @@ class User(db.Model):
     password = db.Column(db.String(80), unique=False, nullable=False)
     is_active = db.Column(db.Boolean(), unique=False, nullable=False)
     name = db.Column(db.String(120), unique=False, nullable=False)
-    favorite_people = db.relationship('FavoritePeople', backref = 'user', lazy=True)
-    favorite_planets = db.relationship('FavoritePlanets', backref= 'user', lazy=True)
-    favorite_vehicles = db.relationship('FavoriteVehicles', backref= 'user', lazy=True)
+    token_version = db.Column(db.Integer, nullable=False, default=0) # va en los tokens, subirlo los invalida todos
+    version = db.Column(db.Integer, nullable=False, default=1) # ETag / If-Match, sube en cada UPDATE
+    favorite_people = db.relationship('FavoritePeople', backref = 'user', lazy=True, passive_deletes=True)
+    favorite_planets = db.relationship('FavoritePlanets', backref= 'user', lazy=True, passive_deletes=True)
+    favorite_vehicles = db.relationship('FavoriteVehicles', backref= 'user', lazy=True, passive_deletes=True)
+
+    __mapper_args__ = {"version_id_col": version} # las escrituras por el ORM (admin) tambien comprueban la version
+
+    # do not serialize the password, its a security breach
+    FIELDS = ("id", "email", "name")
 
     def __repr__(self):
         return '<User %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "email": self.email,
-            "name": self.name
-            # do not serialize the password, its a security breach
-        }
+    def serialize(self, fields=None):
+        return {field: getattr(self, field) for field in (fields or self.FIELDS)}
 
 class People(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -29,19 +54,20 @@ class People(db.Model):
     birthdate = db.Column(db.String(80), unique=False, nullable=False)
     eyes = db.Column(db.String(80), unique=False, nullable=False)
     height = db.Column(db.Float, unique=False, nullable=False)
-    favorite_people = db.relationship('FavoritePeople', backref= 'people', lazy=True)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
+    change_seq = db.Column(db.BigInteger, nullable=False, server_default="0", index=True) # posicion en /changes, ver next_catalog_seq
+    version = db.Column(db.Integer, nullable=False, default=1) # ETag / If-Match, sube en cada UPDATE
+    favorite_people = db.relationship('FavoritePeople', backref= 'people', lazy=True, passive_deletes=True)
+
+    __mapper_args__ = {"version_id_col": version} # las escrituras por el ORM (admin) tambien comprueban la version
+
+    FIELDS = ("id", "name", "birthdate", "eyes", "height")
 
     def __repr__(self):
         return '<People %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "birthdate": self.birthdate,
-            "eyes": self.eyes,
-            "height": self.height
-        }
+    def serialize(self, fields=None):
+        return {field: getattr(self, field) for field in (fields or self.FIELDS)}
 
 class Planets(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -49,19 +75,20 @@ class Planets(db.Model):
     population = db.Column(db.String(80), unique=False, nullable=False)
     surface = db.Column(db.String(80), unique=False, nullable=False)
     diameter = db.Column(db.String(80), unique=False, nullable=False)
-    favorite_planets = db.relationship('FavoritePlanets', backref= 'planets', lazy=True)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
+    change_seq = db.Column(db.BigInteger, nullable=False, server_default="0", index=True) # posicion en /changes, ver next_catalog_seq
+    version = db.Column(db.Integer, nullable=False, default=1) # ETag / If-Match, sube en cada UPDATE
+    favorite_planets = db.relationship('FavoritePlanets', backref= 'planets', lazy=True, passive_deletes=True)
+
+    __mapper_args__ = {"version_id_col": version} # las escrituras por el ORM (admin) tambien comprueban la version
+
+    FIELDS = ("id", "name", "population", "surface", "diameter")
 
     def __repr__(self):
         return '<Planets %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "population": self.population,
-            "surface": self.surface,
-            "diameter": self.diameter
-        }
+    def serialize(self, fields=None):
+        return {field: getattr(self, field) for field in (fields or self.FIELDS)}
 
 class Vehicles(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -69,78 +96,276 @@ class Vehicles(db.Model):
     passengers = db.Column(db.String(80), unique=False, nullable=False)
     length = db.Column(db.String(80), unique=False, nullable=False)
     cargo_capacity = db.Column(db.String(80), unique=False, nullable=False)
-    favorite_vehicles = db.relationship('FavoriteVehicles', backref= 'vehicles', lazy=True)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
+    change_seq = db.Column(db.BigInteger, nullable=False, server_default="0", index=True) # posicion en /changes, ver next_catalog_seq
+    version = db.Column(db.Integer, nullable=False, default=1) # ETag / If-Match, sube en cada UPDATE
+    favorite_vehicles = db.relationship('FavoriteVehicles', backref= 'vehicles', lazy=True, passive_deletes=True)
+
+    __mapper_args__ = {"version_id_col": version} # las escrituras por el ORM (admin) tambien comprueban la version
+
+    FIELDS = ("id", "name", "passengers", "length", "cargo_capacity")
 
     def __repr__(self):
         return '<Vehicles %r>' % self.name
 
+    def serialize(self, fields=None):
+        return {field: getattr(self, field) for field in (fields or self.FIELDS)}
+
+class FavoritePeople (db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', name='fk_favorite_people_user_id_user'), nullable=False)
+    people_id = db.Column(db.Integer, db.ForeignKey('people.id', ondelete='CASCADE', name='fk_favorite_people_people_id_people'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
+    change_seq = db.Column(db.BigInteger, nullable=False, server_default="0") # posicion en /changes, ver next_favorite_seq
+    __table_args__ = (db.Index("ix_favorite_people_user_id_change_seq", "user_id", "change_seq"),)
+
+    sync_kind = "people"
+    item_column = "people_id"
+
+class FavoritePlanets (db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', name='fk_favorite_planets_user_id_user'), nullable=False)
+    planet_id = db.Column(db.Integer, db.ForeignKey('planets.id', ondelete='CASCADE', name='fk_favorite_planets_planet_id_planets'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
+    change_seq = db.Column(db.BigInteger, nullable=False, server_default="0") # posicion en /changes, ver next_favorite_seq
+    __table_args__ = (db.Index("ix_favorite_planets_user_id_change_seq", "user_id", "change_seq"),)
+
+    sync_kind = "planets"
+    item_column = "planet_id"
+
+class FavoriteVehicles (db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', name='fk_favorite_vehicles_user_id_user'), nullable=False)
+    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicles.id', ondelete='CASCADE', name='fk_favorite_vehicles_vehicle_id_vehicles'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
+    change_seq = db.Column(db.BigInteger, nullable=False, server_default="0") # posicion en /changes, ver next_favorite_seq
+    __table_args__ = (db.Index("ix_favorite_vehicles_user_id_change_seq", "user_id", "change_seq"),)
+
+    sync_kind = "vehicles"
+    item_column = "vehicle_id"
+
+class TokenBlockedList(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(250), unique=True, nullable=False)
+    email = db.Column(db.String(50), unique=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
     def serialize(self):
         return {
-            "id": self.id,
-            "name": self.name,
-            "passengers": self.passengers,
-            "length": self.length,
-            "cargo_capacity": self.cargo_capacity
+            "id":self.id,
+            "token":self.token,
+            "email":self.email,
+            "created":self.created_at
         }
 
-class FavoritePeople (db.Model):
+class CatalogStat(db.Model):
+    # contadores precalculados para /stats/<kind>, se actualizan en cada escritura del catalogo
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    people_id = db.Column(db.Integer, db.ForeignKey('people.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    metric = db.Column(db.String(40), nullable=False)
+    bucket = db.Column(db.String(80), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint("kind", "metric", "bucket", name="uq_catalog_stat_kind_metric_bucket"),)
 
     def serialize(self):
         return {
             "id": self.id,
-            "people_id": self.people_id,
-            "user_id": self.user_id,
-            "people_name": People.query.get(self.people_id).serialize()["name"],
-            "user_name": User.query.get(self.user_id).serialize()["name"],
-            "user":User.query.get(self.user_id).serialize(),
-            "people":People.query.get(self.people_id).serialize()
+            "kind": self.kind,
+            "metric": self.metric,
+            "bucket": self.bucket,
+            "count": self.count
         }
 
-class FavoritePlanets (db.Model):
+class Tombstone(db.Model):
+    # filas borradas del catalogo, para el feed de /changes
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    planet_id = db.Column(db.Integer, db.ForeignKey('planets.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    change_seq = db.Column(db.BigInteger, nullable=False, server_default="0")
+    __table_args__ = (db.Index("ix_tombstone_kind_change_seq", "kind", "change_seq"),)
 
     def serialize(self):
         return {
             "id": self.id,
-            "planet_id": self.planet_id,
-            "user_id": self.user_id,
-            "planet_name": Planets.query.get(self.planet_id).serialize()["name"],
-            "user_name": User.query.get(self.user_id).serialize()["name"],
-            "user":User.query.get(self.user_id).serialize(),
-            "planet":Planets.query.get(self.planet_id).serialize()
+            "kind": self.kind,
+            "row_id": self.row_id,
+            "deleted_at": self.deleted_at
         }
 
-class FavoriteVehicles (db.Model):
+class FavoriteTombstone(db.Model):
+    # favoritos borrados, vive en el mismo shard que los favoritos del usuario
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicles.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    change_seq = db.Column(db.BigInteger, nullable=False, server_default="0")
+    __table_args__ = (db.Index("ix_favorite_tombstone_user_id_change_seq", "user_id", "change_seq"),)
 
     def serialize(self):
         return {
             "id": self.id,
-            "vehicle_id": self.vehicle_id,
+            "kind": self.kind,
             "user_id": self.user_id,
-            "vehicle_name": Vehicles.query.get(self.vehicle_id).serialize()["name"],
-            "user_name": User.query.get(self.user_id).serialize()["name"],
-            "user":User.query.get(self.user_id).serialize(),
-            "vehicle":Vehicles.query.get(self.vehicle_id).serialize()
+            "item_id": self.item_id,
+            "deleted_at": self.deleted_at
         }
 
-class TokenBlockedList(db.Model):
+class CatalogChangeCounter(db.Model):
+    # una sola fila (id 1): el ultimo change_seq que se dio a una escritura del catalogo
     id = db.Column(db.Integer, primary_key=True)
-    token = db.Column(db.String(250), unique=True, nullable=False)
-    email = db.Column(db.String(50), unique=False)
-    created_at = db.Column(db.DateTime, nullable=False)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class FavoriteChangeCounter(db.Model):
+    # el ultimo change_seq de los favoritos de cada usuario, vive en el shard del usuario
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class Job(db.Model):
+    # trabajos en segundo plano, los ejecuta `flask jobs-worker`
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    args = db.Column(db.Text, nullable=False, default="{}") # JSON
+    status = db.Column(db.String(20), nullable=False, default="queued") # queued, running, done, failed
+    progress = db.Column(db.Float, nullable=False, default=0)
+    message = db.Column(db.String(250))
+    result = db.Column(db.Text) # JSON
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    unique_key = db.Column(db.String(120), unique=True) # evita encolar dos veces el mismo trabajo recurrente
+    run_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    locked_by = db.Column(db.String(120))
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index("ix_job_status_run_at", "status", "run_at"),)
 
     def serialize(self):
         return {
-            "id":self.id,
-            "token":self.token,
-            "email":self.email,
-            "created":self.created_at
-        }
\ No newline at end of file
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "result": self.result,
+            "error": self.error,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "run_at": self.run_at,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+class AuditLog(db.Model):
+    # login, logout y cambios de favoritos, lo escribe en lotes el thread de audit.py
+    id = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String(40), nullable=False)
+    user_id = db.Column(db.Integer) # sin FK: el registro sobrevive al usuario
+    email = db.Column(db.String(120))
+    kind = db.Column(db.String(20))
+    item_id = db.Column(db.Integer)
+    ip = db.Column(db.String(45))
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    __table_args__ = (
+        db.Index("ix_audit_log_user_id_created_at", "user_id", "created_at"),
+        db.Index("ix_audit_log_event_created_at", "event", "created_at"),
+        db.Index("ix_audit_log_created_at", "created_at")
+    )
+
+    FIELDS = ("id", "event", "user_id", "email", "kind", "item_id", "ip", "created_at")
+
+    def serialize(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+def _upsert(model):
+    """INSERT ... ON CONFLICT of the dialect, None when it has none."""
+    dialect = db.engine.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        return (sqlite.insert if dialect == "sqlite" else postgresql.insert)(model)
+    return None
+
+def _next_seq(executor, counter, key_name, key):
+    """Next value of the counter row key (created at 1). The UPDATE keeps the row locked
+    until the commit, so the writers take their numbers in commit order: once a number is
+    visible every smaller one is too. executor is db.session or the flush connection."""
+    key_column = getattr(counter, key_name)
+    upsert = _upsert(counter)
+    if upsert is not None:
+        upsert = upsert.values({key_name: key, "value": 1})
+        return executor.execute(upsert.on_conflict_do_update(
+            index_elements=[key_name], set_={"value": counter.value + 1}
+        ).returning(counter.value)).scalar_one()
+
+    if executor.execute(update(counter).where(key_column == key).values(value=counter.value + 1)).rowcount == 0:
+        executor.execute(insert(counter).values({key_name: key, "value": 1}))
+    return executor.execute(select(counter.value).where(key_column == key)).scalar_one()
+
+def next_catalog_seq(executor):
+    """change_seq for a write of people, planets or vehicles. Serializes the catalog writers
+    until their commit."""
+    return _next_seq(executor, CatalogChangeCounter, "id", 1)
+
+def next_favorite_seq(executor, user_id):
+    """change_seq for a write of the favorites of user_id, on the shard of user_id."""
+    return _next_seq(executor, FavoriteChangeCounter, "user_id", user_id)
+
+def bump_favorite_seqs(model, condition):
+    """next_favorite_seq() for every user with a favorite of model matching condition; the
+    new value is in FavoriteChangeCounter.value of each user."""
+    users = select(model.user_id, literal(1)).where(condition).distinct().order_by(model.user_id)
+    upsert = _upsert(FavoriteChangeCounter)
+    if upsert is not None:
+        db.session.execute(upsert.from_select(["user_id", "value"], users).on_conflict_do_update(
+            index_elements=["user_id"], set_={"value": FavoriteChangeCounter.value + 1}
+        ))
+        return
+    for user_id in db.session.execute(users).scalars().all():
+        next_favorite_seq(db.session, user_id)
+
+@event.listens_for(People, "before_insert")
+@event.listens_for(Planets, "before_insert")
+@event.listens_for(Vehicles, "before_insert")
+def stamp_catalog_insert(mapper, connection, target):
+    target.change_seq = next_catalog_seq(connection)
+
+@event.listens_for(People, "before_update")
+@event.listens_for(Planets, "before_update")
+@event.listens_for(Vehicles, "before_update")
+def stamp_catalog_update(mapper, connection, target):
+    # before_update tambien llega por cambios solo de relaciones, esos no son un cambio de la fila
+    if object_session(target).is_modified(target, include_collections=False):
+        target.change_seq = next_catalog_seq(connection)
+
+@event.listens_for(FavoritePeople, "before_insert")
+@event.listens_for(FavoritePlanets, "before_insert")
+@event.listens_for(FavoriteVehicles, "before_insert")
+def stamp_favorite_insert(mapper, connection, target):
+    target.change_seq = next_favorite_seq(connection, target.user_id)
+
+@event.listens_for(FavoritePeople, "before_update")
+@event.listens_for(FavoritePlanets, "before_update")
+@event.listens_for(FavoriteVehicles, "before_update")
+def stamp_favorite_update(mapper, connection, target):
+    if object_session(target).is_modified(target, include_collections=False):
+        target.change_seq = next_favorite_seq(connection, target.user_id)
+
+@event.listens_for(People, "after_delete")
+@event.listens_for(Planets, "after_delete")
+@event.listens_for(Vehicles, "after_delete")
+def record_tombstone(mapper, connection, target):
+    connection.execute(Tombstone.__table__.insert().values(
+        kind=target.__tablename__, row_id=target.id, deleted_at=utcnow(), change_seq=next_catalog_seq(connection)
+    ))
+
+@event.listens_for(FavoritePeople, "after_delete")
+@event.listens_for(FavoritePlanets, "after_delete")
+@event.listens_for(FavoriteVehicles, "after_delete")
+def record_favorite_tombstone(mapper, connection, target):
+    connection.execute(FavoriteTombstone.__table__.insert().values(
+        kind=target.sync_kind, user_id=target.user_id, item_id=getattr(target, target.item_column), deleted_at=utcnow(),
+        change_seq=next_favorite_seq(connection, target.user_id)
+    ))
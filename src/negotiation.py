@@ -0,0 +1,88 @@
+"""
+MessagePack as an alternative to JSON for every route. Clients that send
+`Accept: application/msgpack` get their jsonify() responses (errors included) packed with
+msgpack, and bodies sent with `Content-Type: application/msgpack` are returned by
+request.get_json() like a JSON body. Everything else keeps using JSON.
+"""
+import json
+import time
+
+import click
+import msgpack
+from flask import Request, request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+MSGPACK = "application/msgpack"
+
+def wants_msgpack():
+    """True when the client prefers msgpack over JSON (JSON wins ties and */*)."""
+    if not has_request_context():
+        return False
+    return request.accept_mimetypes.best_match(["application/json", MSGPACK]) == MSGPACK
+
+class MsgPackJSONProvider(DefaultJSONProvider):
+
+    def packb(self, obj):
+        # fechas, Decimal, UUID... igual que en el JSON
+        return msgpack.packb(obj, default=self.default, use_bin_type=True, datetime=False)
+
+    def response(self, *args, **kwargs):
+        if not wants_msgpack():
+            response = super().response(*args, **kwargs)
+        else:
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(self.packb(obj), mimetype=MSGPACK)
+        response.vary.add("Accept")
+        return response
+
+class MsgPackRequest(Request):
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype != MSGPACK:
+            return super().get_json(force=force, silent=silent, cache=cache)
+
+        if cache and self._cached_json[silent] is not Ellipsis:
+            return self._cached_json[silent]
+
+        try:
+            data = msgpack.unpackb(self.get_data(cache=cache), raw=False)
+        except (ValueError, msgpack.UnpackException) as error:
+            if silent:
+                return None
+            return self.on_json_loading_failed(error) # 400, como un JSON mal formado
+
+        if cache:
+            self._cached_json = (data, data)
+        return data
+
+def _timed(fn, value, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(value)
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+def setup_msgpack(app):
+    app.json = MsgPackJSONProvider(app)
+    app.request_class = MsgPackRequest
+
+    @app.cli.command("bench-msgpack")
+    @click.option("--rows", default=10000, show_default=True, help="Rows in the benchmark payload.")
+    @click.option("--repeat", default=20, show_default=True, help="Runs of each encode and decode.")
+    def bench_msgpack(rows, repeat):
+        """Compare JSON and msgpack size and encode/decode time on a catalog-like payload."""
+        from models import select_fields, People
+        sample = select_fields(People, People.FIELDS) or [
+            {"id": 1, "name": "Luke Skywalker", "birthdate": "19BBY", "eyes": "blue", "height": 1.72}
+        ]
+        payload = {"msg": "ok", "people": [dict(sample[index % len(sample)], id=index + 1) for index in range(rows)]}
+
+        provider = app.json
+        encoded_json, json_encode = _timed(lambda value: provider.dumps(value, separators=(",", ":")).encode("utf-8"), payload, repeat)
+        encoded_msgpack, msgpack_encode = _timed(provider.packb, payload, repeat)
+        decoded, json_decode = _timed(json.loads, encoded_json, repeat)
+        decoded, msgpack_decode = _timed(lambda value: msgpack.unpackb(value, raw=False), encoded_msgpack, repeat)
+
+        click.echo("%d rows, mean of %d runs" % (rows, repeat))
+        click.echo("%-8s %12s %12s %12s" % ("format", "bytes", "encode_ms", "decode_ms"))
+        click.echo("%-8s %12d %12.2f %12.2f" % ("json", len(encoded_json), json_encode, json_decode))
+        click.echo("%-8s %12d %12.2f %12.2f" % ("msgpack", len(encoded_msgpack), msgpack_encode, msgpack_decode))
@@ -0,0 +1,262 @@
+"""
+On-demand profiling of a single request. With PROFILE_DIR set, a request carrying the
+internal key (X-Internal-Key) and `X-Profile: sample` or `?_profile=sample` is profiled by a
+sampling thread (collapsed stacks, open it in speedscope or flamegraph.pl), `cprofile` uses
+cProfile instead (.pstats, plus collapsed stacks rebuilt from its caller graph). The SQL
+statements the request ran are saved next to it and the response says where in
+X-Profile-Id. Without PROFILE_DIR nothing is registered.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+from collections import Counter
+
+from flask import g, request, jsonify, send_file, current_app
+from sqlalchemy import event
+
+from models import db
+from utils import APIException, internal_only
+
+MODES = ("sample", "cprofile")
+
+def _label(filename, line, name):
+    return "%s (%s:%d)" % (name, os.path.basename(filename), line)
+
+class Sampler:
+    """Samples the stack of one thread every interval seconds from another thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(_label(code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.stacks.most_common())
+
+def collapsed_from_stats(profiler, min_seconds=1e-6):
+    """Collapsed stacks of a cProfile run, weighted in microseconds of self time. cProfile only
+    keeps the direct callers of each function, so the self time is pushed up the caller graph
+    split in proportion to the time of each call edge: deeper than one level the stacks are an
+    estimate. Branches under min_seconds stop growing there, and recursion is cut where a
+    function is already on the stack."""
+    stats = pstats.Stats(profiler).stats
+    stacks = Counter()
+
+    def walk(func, seconds, path):
+        edges = [(caller, edge) for caller, edge in stats.get(func, (0, 0, 0, 0, {}))[4].items() if caller not in path]
+        # tiempo acumulado de cada arista, o su numero de llamadas si ninguna llego a medir tiempo
+        by_time = any(edge[3] for caller, edge in edges)
+        callers = [(caller, edge[3] if by_time else edge[1]) for caller, edge in edges]
+        total = sum(share for caller, share in callers)
+        if not total:
+            stacks[";".join(_label(*frame) for frame in reversed(path))] += seconds
+            return
+        cut = 0
+        for caller, share in callers:
+            part = seconds * share / total
+            if part >= min_seconds:
+                walk(caller, part, path + (caller,))
+            else:
+                cut += part
+        if cut:
+            stacks[";".join(_label(*frame) for frame in reversed(path))] += cut # el stack cortado, sin perder el tiempo
+
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        if tt:
+            walk(func, tt, (func,))
+
+    return "".join("%s %d\n" % (stack, round(seconds * 1000000)) for stack, seconds in stacks.most_common()
+                   if round(seconds * 1000000))
+
+class SQLCapture:
+    """Statements of the profiled threads. The engine listeners are installed once at setup:
+    adding or removing them while other threads run statements breaks those statements."""
+
+    def __init__(self):
+        self._active = {} # thread id -> lista de sentencias
+
+    def install(self, engines):
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._before)
+            event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() in self._active:
+            conn.info["profile_query_start"] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        queries = self._active.get(threading.get_ident())
+        if queries is not None and "profile_query_start" in conn.info:
+            elapsed_ms = (time.perf_counter() - conn.info.pop("profile_query_start")) * 1000
+            queries.append({"statement": statement, "ms": round(elapsed_ms, 3), "executemany": executemany})
+
+    def begin(self):
+        queries = []
+        self._active[threading.get_ident()] = queries
+        return queries
+
+    def end(self):
+        self._active.pop(threading.get_ident(), None)
+
+sql_capture = SQLCapture()
+
+def _requested_mode():
+    mode = request.headers.get("X-Profile") or request.args.get("_profile")
+    if mode is None:
+        return None
+    key = current_app.config.get("INTERNAL_API_KEY")
+    if not key or not hmac.compare_digest(request.headers.get("X-Internal-Key", ""), key):
+        raise APIException("Forbidden", status_code=403)
+    if mode not in MODES:
+        raise APIException("Unknown profile mode, use " + ", ".join(MODES), status_code=400)
+    return mode
+
+def _prune(directory, keep):
+    metadata = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    for name in metadata[:-keep] if keep else []:
+        profile_id = name[:-len(".json")]
+        for existing in os.listdir(directory):
+            if existing.startswith(profile_id):
+                os.remove(os.path.join(directory, existing))
+
+def _load(directory, profile_id):
+    if not profile_id.replace("-", "").isalnum():
+        raise APIException('profile no encontrado', status_code=404)
+    path = os.path.join(directory, profile_id + ".json")
+    if not os.path.exists(path):
+        raise APIException('profile no encontrado', status_code=404)
+    with open(path) as metadata:
+        return json.load(metadata)
+
+def setup_profiling(app):
+    directory = os.getenv("PROFILE_DIR")
+    if not directory:
+        return # sin PROFILE_DIR no hay hooks: cero costo por request
+
+    os.makedirs(directory, exist_ok=True)
+    interval = float(os.getenv("PROFILE_SAMPLE_MS", 1)) / 1000
+    keep = int(os.getenv("PROFILE_KEEP", 50))
+
+    with app.app_context():
+        sql_capture.install(db.engines.values())
+
+    @app.before_request
+    def start_profile():
+        mode = _requested_mode()
+        if mode is None:
+            return
+
+        g.profile = {"mode": mode, "start": time.perf_counter(), "queries": sql_capture.begin()}
+        if mode == "sample":
+            g.profile["profiler"] = Sampler(threading.get_ident(), interval)
+            g.profile["profiler"].start()
+        else:
+            g.profile["profiler"] = cProfile.Profile()
+            g.profile["profiler"].enable()
+
+    @app.after_request
+    def stop_profile(response):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+
+        profiler = profile["profiler"]
+        if profile["mode"] == "sample":
+            profiler.stop()
+        else:
+            profiler.disable()
+        sql_capture.end()
+        duration_ms = (time.perf_counter() - profile["start"]) * 1000
+
+        profile_id = "%s-%s" % (time.strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+        collapsed = profile_id + ".collapsed"
+        if profile["mode"] == "sample":
+            filename = collapsed
+            stacks = profiler.collapsed()
+        else:
+            filename = profile_id + ".pstats"
+            profiler.dump_stats(os.path.join(directory, filename))
+            stacks = collapsed_from_stats(profiler)
+        with open(os.path.join(directory, collapsed), "w") as output:
+            output.write(stacks)
+
+        with open(os.path.join(directory, profile_id + ".json"), "w") as output:
+            json.dump({
+                "id": profile_id,
+                "mode": profile["mode"],
+                "file": filename,
+                "collapsed": collapsed,
+                "method": request.method,
+                "path": request.full_path.rstrip("?"),
+                "endpoint": request.endpoint,
+                "status": response.status_code,
+                "duration_ms": round(duration_ms, 3),
+                "sql_ms": round(sum(query["ms"] for query in profile["queries"]), 3),
+                "queries": profile["queries"],
+                "created_at": time.time()
+            }, output)
+        _prune(directory, keep)
+
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    @app.teardown_request
+    def abandon_profile(error):
+        # la respuesta fallo antes de after_request: no dejar el thread ni los listeners
+        profile = g.pop("profile", None)
+        if profile is not None:
+            if profile["mode"] == "sample":
+                profile["profiler"].stop()
+            else:
+                profile["profiler"].disable()
+            sql_capture.end()
+
+    @app.route('/internal/profiles', methods=['GET'])
+    @internal_only
+    def get_profiles():
+        profiles = []
+        for name in sorted(os.listdir(directory), reverse=True):
+            if name.endswith(".json"):
+                metadata = _load(directory, name[:-len(".json")])
+                metadata["query_count"] = len(metadata.pop("queries"))
+                profiles.append(metadata)
+        return jsonify({"msg": "ok", "profiles": profiles}), 200
+
+    @app.route('/internal/profiles/<profile_id>', methods=['GET'])
+    @internal_only
+    def get_profile(profile_id):
+        return jsonify(_load(directory, profile_id)), 200
+
+    @app.route('/internal/profiles/<profile_id>/download', methods=['GET'])
+    @internal_only
+    def download_profile(profile_id):
+        # ?format=collapsed: los stacks para speedscope tambien en modo cprofile
+        metadata = _load(directory, profile_id)
+        filename = metadata["collapsed"] if request.args.get("format") == "collapsed" else metadata["file"]
+        return send_file(os.path.abspath(os.path.join(directory, filename)), as_attachment=True, download_name=filename)
@@ -0,0 +1,164 @@
+"""
+Data access for the hot query shapes: get by id, user by email, token blocklist lookup and
+the favorites of a user. Each statement is built once per process with bindparam()s and
+reused, so SQLAlchemy neither rebuilds the query nor recomputes its cache key, and its SQL
+comes from the compiled-statement cache. Every statement carries the execution option
+query_shape; the hits and misses of the compiled cache per shape are in
+GET /internal/queries, and `flask bench-queries` measures the per-call cost against the
+legacy Model.query calls.
+"""
+import time
+import threading
+from collections import Counter
+
+import click
+from flask import jsonify
+from sqlalchemy import event, select, bindparam
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+
+from models import db, User, People, TokenBlockedList, FavoritePeople
+from utils import internal_only
+
+OTHER = "other" # sentencias sin query_shape
+
+_statements = {}
+
+def _statement(shape, model, build):
+    """The statement of shape for model, built the first time."""
+    statement = _statements.get((shape, model))
+    if statement is None:
+        statement = _statements[(shape, model)] = build().execution_options(query_shape=shape)
+    return statement
+
+def get_by_id(model, id):
+    """ORM object of model with id, None when it does not exist."""
+    statement = _statement("get_by_id", model, lambda: select(model).where(model.id == bindparam("id")))
+    return db.session.execute(statement, {"id": id}).scalar_one_or_none()
+
+def user_by_email(email):
+    statement = _statement("user_by_email", User, lambda: select(User).where(User.email == bindparam("email")))
+    return db.session.execute(statement, {"email": email}).scalar_one_or_none()
+
+def token_blocked(jti):
+    """True when the token with this jti was revoked."""
+    statement = _statement("token_blocked", TokenBlockedList,
+                           lambda: select(TokenBlockedList.id).where(TokenBlockedList.token == bindparam("jti")).limit(1))
+    return db.session.execute(statement, {"jti": jti}).first() is not None
+
+def favorite(favorite_model, user_id, item_id):
+    """The favorite of user_id for item_id, None when it does not exist. The shard of
+    user_id must already be selected."""
+    def build():
+        item_column = getattr(favorite_model, favorite_model.item_column)
+        return select(favorite_model).where(favorite_model.user_id == bindparam("user_id"), item_column == bindparam("item_id")).limit(1)
+    statement = _statement("favorite", favorite_model, build)
+    return db.session.execute(statement, {"user_id": user_id, "item_id": item_id}).scalar_one_or_none()
+
+def favorites_by_user(favorite_model, user_id, since=None, until=None):
+    """(item id, change_seq) of the favorites of user_id in insertion order, only the ones
+    changed after since and up to until if since is given. The shard of user_id must
+    already be selected."""
+    def build(with_since):
+        item_column = getattr(favorite_model, favorite_model.item_column)
+        criteria = [favorite_model.user_id == bindparam("user_id")]
+        if with_since:
+            criteria.extend((favorite_model.change_seq > bindparam("since"), favorite_model.change_seq <= bindparam("until")))
+        return select(item_column, favorite_model.change_seq).where(*criteria).order_by(favorite_model.id)
+
+    if since is None:
+        statement = _statement("favorites_by_user", favorite_model, lambda: build(False))
+        return db.session.execute(statement, {"user_id": user_id}).all()
+    statement = _statement("favorites_by_user_since", favorite_model, lambda: build(True))
+    return db.session.execute(statement, {"user_id": user_id, "since": since, "until": until}).all()
+
+class CacheStats:
+    """Compiled-cache outcome of every statement, per query_shape."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, shape, cache_hit):
+        outcome = "hits" if cache_hit is CACHE_HIT else "misses" if cache_hit is CACHE_MISS else "uncached"
+        with self._lock:
+            counts = self._counts.get(shape)
+            if counts is None:
+                counts = self._counts[shape] = Counter()
+            counts[outcome] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def summary(self):
+        with self._lock:
+            items = [(shape, dict(counts)) for shape, counts in self._counts.items()]
+
+        result = []
+        for shape, counts in sorted(items):
+            cacheable = counts.get("hits", 0) + counts.get("misses", 0)
+            result.append({
+                "shape": shape,
+                "hits": counts.get("hits", 0),
+                "misses": counts.get("misses", 0),
+                "uncached": counts.get("uncached", 0),
+                "hit_ratio": round(counts.get("hits", 0) / cacheable, 4) if cacheable else None
+            })
+        return result
+
+cache_stats = CacheStats()
+
+def _timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000000 / repeat
+
+def setup_queries(app):
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            cache_stats.record(context.execution_options.get("query_shape", OTHER), context.cache_hit)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    @app.route('/internal/queries', methods=['GET'])
+    @internal_only
+    def get_query_cache_stats():
+        return jsonify({"msg": "ok", "shapes": cache_stats.summary()}), 200
+
+    @app.route('/internal/queries', methods=['DELETE'])
+    @internal_only
+    def reset_query_cache_stats():
+        cache_stats.reset()
+        return jsonify({"msg": "ok"}), 200
+
+    @app.cli.command("bench-queries")
+    @click.option("--repeat", default=2000, show_default=True, help="Calls of each query.")
+    def bench_queries(repeat):
+        """Per-call time of the legacy Model.query calls and of the prebuilt statements."""
+        # sin el identity map cada llamada va a la base de datos, como en un request nuevo
+        def fresh(fn):
+            def call():
+                db.session.expunge_all()
+                fn()
+            return call
+
+        cases = [
+            ("get_by_id", lambda: People.query.get(1), lambda: get_by_id(People, 1)),
+            ("user_by_email", lambda: User.query.filter_by(email="bench@example.com").first(), lambda: user_by_email("bench@example.com")),
+            ("token_blocked", lambda: TokenBlockedList.query.filter_by(token="bench").first() is not None, lambda: token_blocked("bench")),
+            ("favorite", lambda: FavoritePeople.query.filter_by(user_id=1, people_id=1).first(), lambda: favorite(FavoritePeople, 1, 1)),
+            ("favorites_by_user", lambda: db.session.execute(select(FavoritePeople.people_id, FavoritePeople.change_seq).where(FavoritePeople.user_id == 1).order_by(FavoritePeople.id)).all(),
+             lambda: favorites_by_user(FavoritePeople, 1))
+        ]
+
+        click.echo("mean of %d calls" % repeat)
+        click.echo("%-18s %12s %12s %10s" % ("query", "legacy_us", "cached_us", "saved"))
+        for name, legacy, cached in cases:
+            legacy_us = _timed(fresh(legacy), repeat)
+            cached_us = _timed(fresh(cached), repeat)
+            click.echo("%-18s %12.1f %12.1f %9.0f%%" % (name, legacy_us, cached_us, (1 - cached_us / legacy_us) * 100))
+        db.session.rollback()
@@ -0,0 +1,238 @@
+"""
+Item-to-item recommendations ("users who favorited Luke also favorited ..."). Every catalog
+row that has favorites gets an index, and the item x item co-occurrence (how many users
+favorited both) is kept in memory with numpy, one sorted row of partners and counts per item
+so only the pairs that occur take memory. The favorite handlers update it incrementally, and
+a background thread rebuilds it from the favorites tables every
+RECOMMENDATIONS_RESYNC_SECONDS to pick up the writes handled by other workers. Scoring a
+user is one vectorized cosine over the rows of their items, independent of the number of
+users.
+"""
+import os
+import time
+import threading
+
+import numpy as np
+from flask import jsonify, request, current_app
+from sqlalchemy import select
+
+import queries
+from models import db, select_fields, People, Planets, Vehicles, FavoritePeople, FavoritePlanets, FavoriteVehicles
+from routing import read_only
+from singleflight import single_flight
+from sharding import use_shard, fan_out
+from utils import APIException
+
+RESYNC_SECONDS = float(os.getenv("RECOMMENDATIONS_RESYNC_SECONDS", 300))
+PAIRS_PER_CHUNK = 4000000 # pares (item, item) por bincount, limita la memoria del rebuild
+
+FAVORITE_TABLES = {"people": FavoritePeople, "planets": FavoritePlanets, "vehicles": FavoriteVehicles}
+CATALOG = {"people": People, "planets": Planets, "vehicles": Vehicles}
+
+def user_items(user_id):
+    """(kind, id) of every favorite of user_id, the shard must already be selected."""
+    items = []
+    for kind, model in FAVORITE_TABLES.items():
+        items.extend((kind, item_id) for item_id, change_seq in queries.favorites_by_user(model, user_id))
+    return items
+
+def _all_favorites():
+    """(user_id, kind, id) of every favorite, from every shard."""
+    def read():
+        rows = []
+        for kind, model in FAVORITE_TABLES.items():
+            column = getattr(model, model.item_column)
+            rows.extend((user_id, kind, item_id) for user_id, item_id in db.session.execute(select(model.user_id, column)))
+        return rows
+    return [row for rows in fan_out(read) for row in rows]
+
+def _merge_pairs(codes, counts, new_codes, new_counts):
+    """Sum of two (sorted unique pair codes, counts) sets."""
+    merged, inverse = np.unique(np.concatenate((codes, new_codes)), return_inverse=True)
+    return merged, np.bincount(inverse, weights=np.concatenate((counts, new_counts)), minlength=len(merged)).astype(np.int64)
+
+def cooccurrence(user_ids, item_indexes, size):
+    """Sparse item x item matrix with the number of users that have both items, as
+    (users per item, indptr, partners, counts) in CSR form without the diagonal. All the
+    pairs of each user are generated with numpy, only the nonzero ones are kept."""
+    users_per_item = np.bincount(item_indexes, minlength=size).astype(np.int64)
+    codes = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+
+    if len(user_ids):
+        order = np.lexsort((item_indexes, user_ids))
+        users = user_ids[order]
+        items = item_indexes[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(users)) + 1))
+        lengths = np.diff(np.append(starts, len(users)))
+
+        # usuarios en bloques para no generar todos los pares de una vez
+        first = 0
+        pair_counts = np.cumsum(lengths ** 2)
+        while first < len(starts):
+            done = pair_counts[first - 1] if first else 0
+            last = max(first + 1, int(np.searchsorted(pair_counts, done + PAIRS_PER_CHUNK, side="right")))
+            block_starts, block_lengths = starts[first:last], lengths[first:last]
+
+            group_size = np.repeat(block_lengths, block_lengths)     # por fila: cuantos items tiene su usuario
+            group_start = np.repeat(block_starts, block_lengths)     # por fila: donde empieza su usuario
+            rows = np.arange(block_starts[0], block_starts[-1] + block_lengths[-1])
+            left = np.repeat(items[rows], group_size)
+            offsets = np.arange(group_size.sum()) - np.repeat(np.cumsum(group_size) - group_size, group_size)
+            right = items[np.repeat(group_start, group_size) + offsets]
+
+            off_diagonal = left != right
+            block_codes, block_counts = np.unique(left[off_diagonal] * size + right[off_diagonal], return_counts=True)
+            codes, counts = _merge_pairs(codes, counts, block_codes, block_counts)
+            first = last
+
+    indptr = np.searchsorted(codes // size, np.arange(size + 1))
+    return users_per_item, indptr, codes % size, counts
+
+class FavoritesIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None # (kind, id) -> posicion del item
+        self._keys = []
+        self._users = None # usuarios por item (la diagonal)
+        self._partners = [] # por item: posiciones de los items con algun usuario en comun, ordenadas
+        self._counts = [] # por item: cuantos usuarios en comun con cada uno de _partners
+        self._build_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._users is not None
+
+    def rebuild(self):
+        rows = _all_favorites()
+        keys = sorted({(kind, item_id) for user_id, kind, item_id in rows})
+        index = {key: position for position, key in enumerate(keys)}
+        user_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        item_indexes = np.array([index[(row[1], row[2])] for row in rows], dtype=np.int64)
+        users, indptr, partners, counts = cooccurrence(user_ids, item_indexes, max(len(keys), 1))
+        row_partners = [partners[indptr[position]:indptr[position + 1]] for position in range(len(keys))]
+        row_counts = [counts[indptr[position]:indptr[position + 1]] for position in range(len(keys))]
+
+        with self._lock:
+            self._index, self._keys, self._users = index, keys, users
+            self._partners, self._counts = row_partners, row_counts
+        return len(rows)
+
+    def _position(self, key):
+        """Position of key, adding the items that had no favorites. Under the lock."""
+        position = self._index.get(key)
+        if position is None:
+            position = self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._partners.append(np.zeros(0, dtype=np.int64))
+            self._counts.append(np.zeros(0, dtype=np.int64))
+            if position >= len(self._users):
+                self._users = np.concatenate((self._users, np.zeros(len(self._users), dtype=np.int64)))
+        return position
+
+    def _add_pairs(self, position, partners, delta):
+        """Add delta to the pairs (position, partners). Replaces the row arrays instead of
+        writing into them, similar() may be reading the old ones."""
+        partners = np.asarray(partners, dtype=np.int64)
+        codes, counts = _merge_pairs(self._partners[position], self._counts[position], partners, np.full(len(partners), delta, dtype=np.int64))
+        kept = counts != 0
+        self._partners[position], self._counts[position] = codes[kept], counts[kept]
+
+    def update(self, key, others, delta):
+        """The user of others (their other favorites) added (+1) or removed (-1) key."""
+        if not self.ready:
+            return
+        with self._lock:
+            position = self._position(key)
+            other_positions = sorted({self._position(other) for other in others if other != key})
+            users = self._users.copy()
+            users[position] += delta
+            self._users = users
+            self._add_pairs(position, other_positions, delta)
+            for other in other_positions:
+                self._add_pairs(other, [position], delta)
+
+    def similar(self, keys, limit, kind=None):
+        """[(kind, id, score)] most similar to keys (cosine over users), keys excluded."""
+        with self._lock:
+            index, all_keys = self._index, list(self._keys)
+            positions = [index[key] for key in keys if key in index]
+            size = len(all_keys)
+            counts = self._users[:size].astype(float)
+            rows = [(position, self._partners[position], self._counts[position]) for position in positions]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if not rows:
+                scores = counts / max(counts.max(initial=0), 1) # sin favoritos: los mas populares
+            else:
+                partners = np.concatenate([row_partners for position, row_partners, row_counts in rows])
+                cosines = np.concatenate([row_counts / (np.sqrt(counts[position]) * np.sqrt(counts[row_partners]))
+                                          for position, row_partners, row_counts in rows])
+                scores = np.bincount(partners, weights=np.nan_to_num(cosines), minlength=size)
+        scores[positions] = 0
+        if kind is not None:
+            scores[[position for position, key in enumerate(all_keys) if key[0] != kind]] = 0
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(all_keys[position][0], all_keys[position][1], float(scores[position])) for position in candidates]
+
+    def ensure_ready(self, app):
+        """Build on first use and start the periodic resync of this worker."""
+        if self.ready:
+            return
+        with self._build_lock:
+            if not self.ready:
+                self.rebuild()
+                threading.Thread(target=self._resync_loop, args=(app,), daemon=True).start()
+
+    def _resync_loop(self, app):
+        while True:
+            time.sleep(RESYNC_SECONDS)
+            try:
+                with app.app_context():
+                    self.rebuild()
+                    db.session.remove()
+            except Exception:
+                app.logger.exception("recommendations resync failed")
+
+favorites_index = FavoritesIndex()
+
+def favorite_added(user_id, kind, item_id):
+    """Call after committing a new favorite, with the shard of user_id selected."""
+    if favorites_index.ready:
+        favorites_index.update((kind, item_id), user_items(user_id), 1)
+
+def favorite_removed(user_id, kind, item_id):
+    if favorites_index.ready:
+        favorites_index.update((kind, item_id), user_items(user_id), -1)
+
+def setup_recommendations(app):
+
+    @app.route('/recommendations/<int:user_id>', methods=['GET'])
+    @read_only
+    @single_flight
+    def get_recommendations(user_id):
+        kind = request.args.get("kind")
+        if kind is not None and kind not in CATALOG:
+            raise APIException('Unknown kind, use people, planets or vehicles', status_code=400)
+        limit = max(1, min(request.args.get("limit", 10, type=int), 100))
+
+        favorites_index.ensure_ready(current_app._get_current_object())
+        use_shard(user_id)
+        similar = favorites_index.similar(user_items(user_id), limit, kind)
+
+        names = {}
+        for item_kind, model in CATALOG.items():
+            ids = [item_id for found_kind, item_id, score in similar if found_kind == item_kind]
+            if ids:
+                names.update({(item_kind, row["id"]): row["name"] for row in select_fields(model, ("id", "name"), model.id.in_(ids))})
+
+        # los borrados del catalogo siguen en la matriz hasta el proximo resync
+        recommendations = [{"kind": item_kind, "id": item_id, "name": names[(item_kind, item_id)], "score": round(score, 4)}
+                           for item_kind, item_id, score in similar if (item_kind, item_id) in names]
+
+        return jsonify({"msg": "ok", "user_id": user_id, "recommendations": recommendations}), 200
@@ -0,0 +1,178 @@
+"""
+Read-replica routing: GET-style routes marked with @read_only send their queries to the
+replicas listed in DATABASE_REPLICA_URLS, everything else (and anything after a write)
+stays on the primary engine. A request keeps the replica it got for all its statements; if
+that replica fails the statement is run again on the next healthy one, or on the primary.
+"""
+import os
+import time
+import itertools
+import threading
+from functools import wraps
+
+import sqlalchemy as sa
+from flask import g, request, has_app_context
+from flask_sqlalchemy.session import Session
+from sharding import shards
+
+REPLICA_BIND_PREFIX = "replica_"
+PIN_COOKIE = "rw_pin"
+
+class ReplicaPool:
+    """Round-robin over the healthy replicas, a replica that errors is skipped until it
+    answers a health check again."""
+
+    def __init__(self):
+        self.keys = []
+        self.retry_seconds = 30
+        self._down = {} # bind key -> momento en que lo volvemos a probar
+        self._by_engine = {}
+        self._cycle = itertools.cycle(())
+        self._lock = threading.Lock()
+
+    def configure(self, keys, retry_seconds):
+        self.keys = list(keys)
+        self.retry_seconds = retry_seconds
+        self._down = {}
+        self._by_engine = {}
+        self._cycle = itertools.cycle(self.keys)
+
+    def mark_down(self, key):
+        with self._lock:
+            self._down[key] = time.monotonic() + self.retry_seconds
+
+    def is_healthy(self, key):
+        return key not in self._down
+
+    def check(self, engines, key):
+        """Run SELECT 1 against the replica, returns True when it is usable."""
+        try:
+            with engines[key].connect() as connection:
+                connection.execute(sa.text("SELECT 1"))
+        except sa.exc.DBAPIError:
+            self.mark_down(key)
+            return False
+
+        with self._lock:
+            self._down.pop(key, None)
+        return True
+
+    def choose(self, engines):
+        """Return the bind key of the next healthy replica, or None to fall back to the primary."""
+        for _ in range(len(self.keys)):
+            with self._lock:
+                key = next(self._cycle)
+            self._by_engine[engines[key]] = key
+
+            retry_at = self._down.get(key)
+            if retry_at is None:
+                return key
+            if retry_at <= time.monotonic() and self.check(engines, key):
+                return key
+
+        return None
+
+    def key_for_engine(self, engine):
+        return self._by_engine.get(engine)
+
+replicas = ReplicaPool()
+
+def _is_write(clause):
+    return isinstance(clause, sa.sql.dml.UpdateBase) or (
+        isinstance(clause, sa.sql.Select) and clause._for_update_arg is not None
+    )
+
+def _replica_failed_error(error):
+    return isinstance(error, sa.exc.OperationalError) or (isinstance(error, sa.exc.DBAPIError) and error.connection_invalidated)
+
+class RoutingSession(Session):
+    """db.session class, picks primary, replica or favorites shard for every statement."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            g.on_replica = False
+            writing = self._flushing or _is_write(clause)
+            if writing:
+                g.wrote = True
+
+            engine = shards.engine_for(self._db.engines, mapper, clause)
+            if engine is not None:
+                return engine
+
+            if not writing and replicas.keys and g.get("read_only") and not g.get("wrote") and not g.get("pin_primary"):
+                # una replica por request: choose() por sentencia mezclaria replicas con distinto atraso
+                if "replica" not in g:
+                    g.replica = replicas.choose(self._db.engines) # None: ninguna sana, el primario
+                if g.replica is not None:
+                    g.on_replica = True
+                    return self._db.engines[g.replica]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _off_failed_replica(self, run):
+        """run() again after a replica error, on the next healthy replica or the primary. The
+        request has only read so far, rolling back the session loses nothing. Ends because
+        every retry marks one more replica down."""
+        while True:
+            try:
+                return run()
+            except sa.exc.DBAPIError as error:
+                if not (has_app_context() and g.get("on_replica")) or not _replica_failed_error(error):
+                    raise
+                replicas.mark_down(g.replica)
+                g.replica = replicas.choose(self._db.engines)
+                self.rollback()
+
+    def execute(self, *args, **kwargs):
+        return self._off_failed_replica(lambda: super(RoutingSession, self).execute(*args, **kwargs))
+
+    def scalar(self, *args, **kwargs):
+        return self._off_failed_replica(lambda: super(RoutingSession, self).scalar(*args, **kwargs))
+
+    def scalars(self, *args, **kwargs):
+        return self._off_failed_replica(lambda: super(RoutingSession, self).scalars(*args, **kwargs))
+
+def read_only(f):
+    """Mark a route as safe to serve from a replica."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return decorated
+
+def configure_replicas(app):
+    """Must run before db.init_app so the replica engines are created with the others."""
+    urls = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+
+    keys = []
+    for index, url in enumerate(urls):
+        key = REPLICA_BIND_PREFIX + str(index)
+        binds[key] = url.replace("postgres://", "postgresql://")
+        keys.append(key)
+
+    app.config["REPLICA_PIN_SECONDS"] = int(os.getenv("REPLICA_PIN_SECONDS", 5))
+    replicas.configure(keys, int(os.getenv("REPLICA_RETRY_SECONDS", 30)))
+
+    @app.before_request
+    def pin_after_recent_write():
+        # read-your-writes: el cliente acaba de escribir, no leemos de una replica atrasada
+        pinned_until = request.cookies.get(PIN_COOKIE)
+        try:
+            if pinned_until is not None and float(pinned_until) > time.time():
+                g.pin_primary = True
+        except ValueError:
+            pass
+
+    @app.after_request
+    def remember_recent_write(response):
+        if replicas.keys and g.get("wrote"):
+            seconds = app.config["REPLICA_PIN_SECONDS"]
+            response.set_cookie(PIN_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True)
+        return response
+
+@sa.event.listens_for(sa.engine.Engine, "handle_error")
+def _replica_failed(context):
+    key = replicas.key_for_engine(context.engine)
+    if key is not None and (context.is_disconnect or isinstance(context.sqlalchemy_exception, sa.exc.OperationalError)):
+        replicas.mark_down(key)
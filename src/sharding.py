@@ -0,0 +1,229 @@
+"""
+Optional horizontal sharding of the favorites tables by user_id. The catalog and the
+users stay on the primary database, favorite_* rows live on one of the databases listed
+in FAVORITES_SHARD_URLS, chosen with a jump consistent hash of the user_id.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import sqlalchemy as sa
+from flask import g, current_app
+
+SHARD_BIND_PREFIX = "favorites_shard_"
+SHARDED_TABLES = {"favorite_people", "favorite_planets", "favorite_vehicles", "favorite_tombstone", "favorite_change_counter"}
+COUNTER_TABLE = "favorite_change_counter"
+
+def jump_hash(key, num_buckets):
+    """Jump consistent hash (Lamping & Veach), growing from N to N+1 shards only moves
+    1/(N+1) of the users."""
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+class ShardMap:
+
+    def __init__(self):
+        self.keys = []
+
+    def configure(self, keys):
+        self.keys = list(keys)
+
+    def shard_for(self, user_id):
+        return jump_hash(int(user_id), len(self.keys))
+
+    def engine_for(self, engines, mapper=None, clause=None):
+        """Engine for a statement on a sharded table, None when it is not sharded."""
+        if not self.keys:
+            return None
+
+        table = _table_of(mapper, clause)
+        if table is None or table.name not in SHARDED_TABLES:
+            return None
+
+        index = g.get("favorites_shard")
+        if index is None:
+            raise RuntimeError("Query on %s without a shard, call use_shard(user_id) first" % table.name)
+
+        return engines[self.keys[index]]
+
+shards = ShardMap()
+
+def _table_of(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table
+    if isinstance(clause, sa.Table):
+        return clause
+    if isinstance(clause, sa.sql.dml.UpdateBase) and isinstance(clause.table, sa.Table):
+        return clause.table
+    return None
+
+def use_shard(user_id):
+    """Send the favorites queries of this request to the shard that owns user_id."""
+    if shards.keys:
+        g.favorites_shard = shards.shard_for(user_id)
+
+def fan_out(fn):
+    """Run fn() once per shard in parallel, each call with its own app context and session.
+    Without sharding it just runs fn() on the primary. Returns the list of results."""
+    if not shards.keys:
+        return [fn()]
+
+    from models import db
+    app = current_app._get_current_object()
+
+    def run_on(index):
+        with app.app_context():
+            g.favorites_shard = index
+            try:
+                return fn()
+            finally:
+                db.session.remove()
+
+    with ThreadPoolExecutor(max_workers=len(shards.keys)) as executor:
+        return list(executor.map(run_on, range(len(shards.keys))))
+
+def purge_favorites(model, condition):
+    """Leave tombstones for /changes of the favorites matching condition. Without sharding
+    ON DELETE CASCADE removes the rows together with the catalog row, with sharding they
+    are deleted here on every shard (any user can reference a catalog row)."""
+    from models import db, FavoriteTombstone, FavoriteChangeCounter, bump_favorite_seqs, utcnow
+    item = getattr(model, model.item_column)
+
+    def purge():
+        # cada usuario afectado toma un change_seq nuevo y sus tombstones lo copian del contador
+        bump_favorite_seqs(model, condition)
+        db.session.execute(sa.insert(FavoriteTombstone).from_select(
+            ["kind", "user_id", "item_id", "deleted_at", "change_seq"],
+            sa.select(sa.literal(model.sync_kind), model.user_id, item, sa.literal(utcnow()), FavoriteChangeCounter.value)
+            .join(FavoriteChangeCounter, FavoriteChangeCounter.user_id == model.user_id).where(condition)
+        ))
+        if shards.keys:
+            db.session.execute(sa.delete(model).where(condition))
+            db.session.commit()
+
+    fan_out(purge)
+
+def purge_user_favorites(user_id):
+    """Favorites of a deleted user, only needed with sharding: on a single database
+    ON DELETE CASCADE already removes them."""
+    if not shards.keys:
+        return
+
+    from models import db, FavoritePeople, FavoritePlanets, FavoriteVehicles
+    use_shard(user_id)
+    for model in (FavoritePeople, FavoritePlanets, FavoriteVehicles):
+        db.session.execute(sa.delete(model).where(model.user_id == user_id))
+
+def _shard_tables():
+    """Copies of the favorites tables without the foreign keys, user/people/planets/vehicles
+    do not exist on the shard databases."""
+    from models import db
+    metadata = sa.MetaData()
+    tables = []
+    for name in sorted(SHARDED_TABLES):
+        source = db.metadata.tables[name]
+        columns = [sa.Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable, autoincrement=c.autoincrement,
+                             server_default=c.server_default.arg if c.server_default is not None else None)
+                   for c in source.columns]
+        table = sa.Table(name, metadata, *columns)
+        for index in source.indexes:
+            sa.Index(index.name, *[table.c[column.name] for column in index.columns])
+        tables.append(table)
+    return metadata, tables
+
+def _raise_counters(connection, counter, rows):
+    """The moved rows keep their change_seq: the counter of their user on the new shard has to
+    start above it, or /changes would hand out numbers the clients already went past."""
+    newest = {}
+    for row in rows:
+        newest[row["user_id"]] = max(newest.get(row["user_id"], 0), row["change_seq"])
+
+    for user_id, change_seq in newest.items():
+        raised = connection.execute(counter.update().where(counter.c.user_id == user_id, counter.c.value < change_seq).values(value=change_seq))
+        if raised.rowcount == 0 and connection.execute(sa.select(counter.c.user_id).where(counter.c.user_id == user_id)).first() is None:
+            connection.execute(counter.insert().values(user_id=user_id, value=change_seq))
+
+def _rebalance_table(table, source, shard_engines, moved, counter):
+    item_columns = [c.name for c in table.columns if c.name != "id"]
+    offset_id = 0
+    batch_size = 1000
+
+    while True:
+        with source.connect() as connection:
+            rows = connection.execute(
+                sa.select(table).where(table.c.id > offset_id).order_by(table.c.id).limit(batch_size)
+            ).mappings().all()
+        if not rows:
+            return
+        offset_id = rows[-1]["id"]
+
+        by_target = {}
+        for row in rows:
+            target = shard_engines[shards.shard_for(row["user_id"])]
+            if target is not source:
+                by_target.setdefault(target, []).append(row)
+
+        for target, target_rows in by_target.items():
+            user_ids = {row["user_id"] for row in target_rows}
+            with target.begin() as connection:
+                existing = set(connection.execute(
+                    sa.select(*[table.c[name] for name in item_columns]).where(table.c.user_id.in_(user_ids))
+                ).all())
+                new_rows = [{name: row[name] for name in item_columns} for row in target_rows
+                            if tuple(row[name] for name in item_columns) not in existing]
+                if new_rows:
+                    connection.execute(table.insert(), new_rows)
+                _raise_counters(connection, counter, target_rows)
+            # se borra del origen solo despues de que el destino hizo commit
+            with source.begin() as connection:
+                connection.execute(table.delete().where(table.c.id.in_([row["id"] for row in target_rows])))
+            moved[table.name] = moved.get(table.name, 0) + len(target_rows)
+
+def configure_sharding(app):
+    """Must run before db.init_app so the shard engines are created with the others."""
+    urls = [url.strip() for url in os.getenv("FAVORITES_SHARD_URLS", "").split(",") if url.strip()]
+    binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+
+    keys = []
+    for index, url in enumerate(urls):
+        key = SHARD_BIND_PREFIX + str(index)
+        binds[key] = url.replace("postgres://", "postgresql://")
+        keys.append(key)
+    shards.configure(keys)
+
+    @app.cli.command("shards-init")
+    def shards_init():
+        """Create the favorites tables on every shard."""
+        from models import db
+        metadata, tables = _shard_tables()
+        for key in shards.keys:
+            metadata.create_all(db.engines[key])
+            click.echo("%s: ok" % key)
+
+    @app.cli.command("shards-rebalance")
+    @click.option("--from-primary", is_flag=True, help="Also move the favorites still stored on the primary database.")
+    def shards_rebalance(from_primary):
+        """Move every favorite to the shard its user_id hashes to, run after changing FAVORITES_SHARD_URLS."""
+        from models import db
+        if not shards.keys:
+            raise click.ClickException("FAVORITES_SHARD_URLS is not configured")
+
+        metadata, tables = _shard_tables()
+        counter = metadata.tables[COUNTER_TABLE]
+        shard_engines = [db.engines[key] for key in shards.keys]
+        sources = shard_engines + ([db.engines[None]] if from_primary else [])
+
+        moved = {}
+        for source in sources:
+            for table in tables:
+                if table is not counter:
+                    _rebalance_table(table, source, shard_engines, moved, counter)
+
+        for name, count in sorted(moved.items()):
+            click.echo("%s: %d rows moved" % (name, count))
+        click.echo("rebalance done")
@@ -0,0 +1,86 @@
+"""
+Single-flight for idempotent GET routes: while one request computes a response, identical
+requests arriving at the same time (same path, query string, Accept and Authorization, and
+same primary/replica routing) wait for it and get a copy of its serialized response
+instead of running the same queries. Errors of the leader are raised in every waiter.
+"""
+import os
+import threading
+from functools import wraps
+
+from flask import g, request, current_app
+
+from utils import APIException
+
+ENABLED = os.getenv("SINGLE_FLIGHT", "1") != "0"
+TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", 10))
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None # (body, status, headers)
+        self.error = None
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout):
+        """fn() once for all the concurrent callers with the same key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise APIException('Timed out waiting for an identical request in flight', status_code=504)
+            if call.error is not None:
+                raise call.error
+            return call.response
+
+        try:
+            call.response = fn()
+            return call.response
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+flights = SingleFlight()
+
+def _request_key():
+    return (
+        request.path,
+        tuple(sorted(request.args.items(multi=True))),
+        request.headers.get("Accept", ""),
+        request.headers.get("Authorization", ""),
+        bool(g.get("pin_primary")) # read-your-writes: no compartir con quien lee de una replica
+    )
+
+def single_flight(f):
+    """Coalesce identical concurrent GETs, put it below the auth decorators."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        # con X-Profile/?_profile la consulta tiene que correr en este request, no en el de otro
+        if not ENABLED or request.method != "GET" or g.get("profile") is not None:
+            return f(*args, **kwargs)
+
+        def compute():
+            response = current_app.make_response(f(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers.items())
+
+        body, status, headers = flights.do(_request_key(), compute, TIMEOUT)
+        return current_app.response_class(body, status=status, headers=headers)
+    return decorated
@@ -0,0 +1,184 @@
+"""
+Slow-query log: every statement on the db engines is timed and grouped by a normalized
+fingerprint, statements over SLOW_QUERY_MS are logged with the Flask endpoint that ran
+them and the first one of each shape gets its EXPLAIN plan captured.
+"""
+import os
+import re
+import time
+import logging
+import threading
+from collections import deque
+
+from flask import jsonify, request, has_request_context
+from sqlalchemy import event
+
+from utils import internal_only
+
+logger = logging.getLogger("slow_query")
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*\?\s*,?)+\)", re.IGNORECASE)
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\$\d+")
+_SPACES = re.compile(r"\s+")
+
+def fingerprint(statement):
+    """Same shape of statement -> same text, literals and IN lists collapsed."""
+    text = _STRING.sub("?", statement)
+    text = _PLACEHOLDER.sub("?", text)
+    text = _NUMBER.sub("?", text)
+    text = _IN_LIST.sub("IN (...)", text)
+    return _SPACES.sub(" ", text).strip()
+
+class QueryStats:
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._shapes = {}
+        self._fingerprints = {} # cache statement -> fingerprint, el texto de SQLAlchemy se repite
+        self._lock = threading.Lock()
+
+    def fingerprint(self, statement):
+        shape = self._fingerprints.get(statement)
+        if shape is None:
+            shape = fingerprint(statement)
+            if len(self._fingerprints) < 10000:
+                self._fingerprints[statement] = shape
+        return shape
+
+    def record(self, shape, elapsed_ms, slow, endpoint):
+        """Returns True the first time a shape is seen slow (its plan is still missing)."""
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                stats = self._shapes[shape] = {
+                    "count": 0, "slow_count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                    "timings": deque(maxlen=self.samples), "endpoints": set(), "plan": None
+                }
+            stats["count"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["timings"].append(elapsed_ms)
+            if not slow:
+                return False
+
+            stats["slow_count"] += 1
+            if endpoint is not None:
+                stats["endpoints"].add(endpoint)
+            if stats["plan"] is None:
+                stats["plan"] = "pending"
+                return True
+            return False
+
+    def set_plan(self, shape, plan):
+        with self._lock:
+            self._shapes[shape]["plan"] = plan
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+
+    def summary(self):
+        with self._lock:
+            items = [(shape, dict(stats, timings=sorted(stats["timings"]), endpoints=sorted(stats["endpoints"])))
+                     for shape, stats in self._shapes.items()]
+
+        result = []
+        for shape, stats in sorted(items, key=lambda item: item[1]["total_ms"], reverse=True):
+            timings = stats["timings"]
+            result.append({
+                "fingerprint": shape,
+                "count": stats["count"],
+                "slow_count": stats["slow_count"],
+                "total_ms": round(stats["total_ms"], 3),
+                "max_ms": round(stats["max_ms"], 3),
+                "p50_ms": percentile(timings, 50),
+                "p95_ms": percentile(timings, 95),
+                "p99_ms": percentile(timings, 99),
+                "endpoints": stats["endpoints"],
+                "plan": stats["plan"]
+            })
+        return result
+
+def percentile(timings, percent):
+    """Nearest-rank percentile of sorted timings, None when empty."""
+    if not timings:
+        return None
+    index = min(len(timings) - 1, int(round(percent / 100.0 * (len(timings) - 1))))
+    return round(timings[index], 3)
+
+query_stats = QueryStats()
+
+def _explain(cursor, dialect_name, statement, parameters, analyze):
+    """Plan of a statement, run on a new cursor of the same DBAPI connection."""
+    verb = statement.lstrip()[:6].lower()
+    if verb not in ("select", "insert", "update", "delete"):
+        return None # DDL y similares no tienen plan
+
+    if dialect_name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif dialect_name == "postgresql":
+        # ANALYZE ejecuta la consulta de verdad, solo para SELECT
+        is_select = verb == "select"
+        prefix = "EXPLAIN ANALYZE " if analyze and is_select else "EXPLAIN "
+    else:
+        return None
+
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute(prefix + statement, parameters)
+        return [" | ".join(str(column) for column in row) for row in explain_cursor.fetchall()]
+    finally:
+        explain_cursor.close()
+
+def setup_slow_query_log(app, db):
+    if os.getenv("SLOW_QUERY_LOG", "1") == "0":
+        return
+
+    threshold_ms = float(os.getenv("SLOW_QUERY_MS", 200))
+    analyze = os.getenv("SLOW_QUERY_EXPLAIN_ANALYZE", "0") == "1"
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start_time"] = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop("query_start_time")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        slow = elapsed_ms >= threshold_ms
+        endpoint = request.endpoint if has_request_context() else None
+
+        shape = query_stats.fingerprint(statement)
+        first_slow = query_stats.record(shape, elapsed_ms, slow, endpoint)
+        if not slow:
+            return
+
+        logger.warning("slow query %.1f ms [%s] %s", elapsed_ms, endpoint or "-", shape)
+        if first_slow:
+            plan = None
+            if not executemany:
+                try:
+                    plan = _explain(cursor, conn.dialect.name, statement, parameters, analyze)
+                except Exception as error:
+                    plan = ["EXPLAIN failed: %s" % error]
+            query_stats.set_plan(shape, plan)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    @app.route('/internal/slow-queries', methods=['GET'])
+    @internal_only
+    def get_slow_queries():
+        return jsonify({
+            "msg": "ok",
+            "threshold_ms": threshold_ms,
+            "queries": query_stats.summary()
+        }), 200
+
+    @app.route('/internal/slow-queries', methods=['DELETE'])
+    @internal_only
+    def reset_slow_queries():
+        query_stats.reset()
+        return jsonify({"msg": "ok"}), 200
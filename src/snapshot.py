@@ -0,0 +1,232 @@
+"""
+Shared catalog snapshot: People, Planets and Vehicles written as pre-encoded JSON rows in
+one binary file that every gunicorn worker maps with mmap, so the list and detail GETs are
+answered without touching the database and the pages are shared between workers.
+
+File layout (little endian):
+    header      magic "SWCS", format version (u32), generation (u64), kind count (u32)
+    kind table  per kind: name (16s), rows (u32), index offset (u64), rows offset (u64), rows length (u64)
+    index       per kind and row: id, offset, length, version (4 x i64), sorted by id
+    rows        per kind: the JSON of every row separated by commas, ready to go inside [ ]
+"""
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import tempfile
+import threading
+
+import click
+from flask import g, request, current_app
+
+from models import select_fields, People, Planets, Vehicles
+from negotiation import wants_msgpack
+
+MAGIC = b"SWCS"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<4sIQI")
+KIND_ENTRY = struct.Struct("<16sIQQQ")
+INDEX_ENTRY = struct.Struct("<qqqq")
+INDEX_WIDTH = 4
+
+CATALOG = {"people": People, "planets": Planets, "vehicles": Vehicles}
+
+class OutdatedSnapshot(ValueError):
+    """The file was written with another FORMAT_VERSION (e.g. by the previous deploy)."""
+
+def _fragment(row):
+    # mismo JSON que jsonify: claves ordenadas y sin espacios
+    return json.dumps(row, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+def write_snapshot(path, tables, generation):
+    """tables: {kind: [(id, version, fragment), ...]} sorted by id. The file is replaced atomically."""
+    kinds = sorted(tables)
+    offset = HEADER.size + KIND_ENTRY.size * len(kinds)
+
+    entries = []
+    index_parts = []
+    for kind in kinds:
+        entries.append([kind, len(tables[kind]), offset, 0, 0])
+        offset += INDEX_ENTRY.size * len(tables[kind])
+
+    rows_parts = []
+    for entry, kind in zip(entries, kinds):
+        entry[3] = offset
+        position = offset
+        parts = []
+        for row_id, version, fragment in tables[kind]:
+            if parts:
+                parts.append(b",")
+                position += 1
+            index_parts.append(INDEX_ENTRY.pack(row_id, position, len(fragment), version))
+            parts.append(fragment)
+            position += len(fragment)
+        entry[4] = position - offset
+        offset = position
+        rows_parts.extend(parts)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    try:
+        with os.fdopen(descriptor, "wb") as output:
+            output.write(HEADER.pack(MAGIC, FORMAT_VERSION, generation, len(kinds)))
+            for kind, count, index_offset, rows_offset, rows_length in entries:
+                output.write(KIND_ENTRY.pack(kind.encode("ascii"), count, index_offset, rows_offset, rows_length))
+            output.write(b"".join(index_parts))
+            output.write(b"".join(rows_parts))
+            output.flush()
+            os.fsync(output.fileno())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+class CatalogSnapshot:
+
+    def __init__(self):
+        self.path = None
+        self._state = None # (clave del archivo, mmap, {kind: (count, index, rows_offset, rows_length)})
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def rebuild(self):
+        """Read the catalog (from the primary) and write a new snapshot, one writer at a time."""
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # el primer uso llega desde un GET @read_only: una replica atrasada dejaria el snapshot viejo
+            pinned = g.get("pin_primary")
+            g.pin_primary = True
+            try:
+                tables = {}
+                for kind, model in CATALOG.items():
+                    rows = select_fields(model, model.FIELDS + ("version",))
+                    tables[kind] = [(row["id"], row.pop("version"), _fragment(row)) for row in rows]
+                write_snapshot(self.path, tables, time.time_ns())
+            finally:
+                g.pin_primary = pinned
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _open(self, key):
+        with open(self.path, "rb") as snapshot_file:
+            mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, generation, kind_count = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a catalog snapshot" % self.path)
+        if version != FORMAT_VERSION:
+            raise OutdatedSnapshot("%s is a catalog snapshot v%d, expected v%d" % (self.path, version, FORMAT_VERSION))
+
+        kinds = {}
+        view = memoryview(mapped)
+        for position in range(kind_count):
+            name, count, index_offset, rows_offset, rows_length = KIND_ENTRY.unpack_from(mapped, HEADER.size + position * KIND_ENTRY.size)
+            index = view[index_offset:index_offset + count * INDEX_ENTRY.size].cast("q")
+            kinds[name.rstrip(b"\0").decode("ascii")] = (count, index, rows_offset, rows_length)
+
+        # el mmap anterior no se cierra: otro thread puede estar leyendolo, lo libera el GC
+        return (key, mapped, kinds)
+
+    def _key(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _current(self):
+        try:
+            key = self._key()
+        except FileNotFoundError:
+            # primer uso: lo escribe el primer worker que llega, los demas esperan el lock
+            self.rebuild()
+            key = self._key()
+
+        state = self._state
+        if state is None or state[0] != key:
+            with self._lock:
+                state = self._state
+                if state is None or state[0] != key:
+                    try:
+                        state = self._open(key)
+                    except OutdatedSnapshot:
+                        self.rebuild()
+                        state = self._open(self._key())
+                    self._state = state
+        return state
+
+    def list_rows(self, kind):
+        """JSON array of every row of kind as bytes."""
+        state = self._current()
+        count, index, rows_offset, rows_length = state[2][kind]
+        return b"[" + state[1][rows_offset:rows_offset + rows_length] + b"]"
+
+    def row(self, kind, row_id):
+        """(JSON of one row as bytes, version), None when the id is not in the snapshot."""
+        state = self._current()
+        count, index, rows_offset, rows_length = state[2][kind]
+
+        low, high = 0, count - 1
+        while low <= high:
+            middle = (low + high) // 2
+            entry = middle * INDEX_WIDTH
+            current_id = index[entry]
+            if current_id == row_id:
+                offset, length, version = index[entry + 1], index[entry + 2], index[entry + 3]
+                return state[1][offset:offset + length], version
+            if current_id < row_id:
+                low = middle + 1
+            else:
+                high = middle - 1
+        return None
+
+catalog_snapshot = CatalogSnapshot()
+
+def _servable():
+    # ?fields y demas parametros van por la base de datos, msgpack por jsonify
+    return catalog_snapshot.enabled and not request.args and not wants_msgpack()
+
+def serve_list(kind):
+    """Response for GET /<kind> from the snapshot, None to fall back to the database."""
+    if not _servable():
+        return None
+    rows = catalog_snapshot.list_rows(kind)
+    body = b'{"msg":"ok","' + kind.encode("ascii") + b'":' + rows + b"}\n"
+    response = current_app.response_class(body, status=200, mimetype="application/json")
+    response.vary.add("Accept")
+    return response
+
+def serve_detail(kind, row_id):
+    """Response for GET /<kind>/<id> from the snapshot, None to fall back to the database."""
+    if not _servable():
+        return None
+    found = catalog_snapshot.row(kind, row_id)
+    if found is None:
+        return None # la base de datos decide (404)
+    row, version = found
+    response = current_app.response_class(row + b"\n", status=200, mimetype="application/json")
+    response.vary.add("Accept")
+    response.set_etag("v%d" % version) # el mismo ETag que la respuesta desde la base de datos
+    return response
+
+def catalog_changed():
+    """Call after committing a catalog write."""
+    if catalog_snapshot.enabled:
+        try:
+            catalog_snapshot.rebuild()
+        except Exception:
+            # la escritura ya hizo commit: no devolver 500, el snapshot viejo sigue sirviendo
+            current_app.logger.exception("catalog snapshot rebuild failed")
+
+def setup_snapshot(app):
+    catalog_snapshot.path = os.getenv("CATALOG_SNAPSHOT_PATH") or None
+
+    @app.cli.command("snapshot-rebuild")
+    def snapshot_rebuild():
+        """Write the shared catalog snapshot (CATALOG_SNAPSHOT_PATH)."""
+        if not catalog_snapshot.enabled:
+            raise click.ClickException("CATALOG_SNAPSHOT_PATH is not configured")
+        catalog_snapshot.rebuild()
+        click.echo("snapshot written to %s" % catalog_snapshot.path)
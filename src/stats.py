@@ -0,0 +1,200 @@
+"""
+Precomputed catalog statistics for GET /stats/<kind>. Every catalog write adds or
+subtracts its row from the catalog_stat counters in the same transaction, so reading them
+costs the same however big the catalog is. `flask stats-rebuild` recomputes them from
+scratch with numpy.
+"""
+import os
+import math
+from collections import Counter
+
+import click
+import numpy as np
+from flask import jsonify
+from sqlalchemy import select, update, insert, delete, text
+from sqlalchemy.dialects import sqlite, postgresql
+
+from models import db, CatalogStat, People, Planets, Vehicles
+from routing import read_only
+from singleflight import single_flight
+from utils import APIException
+
+HEIGHT_BUCKET = float(os.getenv("STATS_HEIGHT_BUCKET", 10))
+UNKNOWN = "unknown"
+
+# kind -> (modelo, [(metrica, columna, tipo de bucket)])
+METRICS = {
+    "people": (People, [("eyes", "eyes", "category"), ("height", "height", "linear")]),
+    "planets": (Planets, [("population", "population", "magnitude"), ("diameter", "diameter", "magnitude")]),
+    "vehicles": (Vehicles, [("passengers", "passengers", "magnitude"), ("length", "length", "magnitude")])
+}
+
+def stat_columns(kind):
+    model, metrics = METRICS[kind]
+    return [getattr(model, column) for metric, column, bucketing in metrics]
+
+def _label(number):
+    return str(int(number)) if float(number).is_integer() else repr(float(number))
+
+def _to_number(value):
+    """Strings like "200000", "1,000" or "unknown" from the catalog, None when not a number."""
+    try:
+        number = float(str(value).replace(",", ""))
+    except ValueError:
+        return None
+    return number if math.isfinite(number) and number >= 0 else None
+
+def bucket(bucketing, value):
+    if bucketing == "category":
+        return str(value)
+
+    number = _to_number(value)
+    if number is None:
+        return UNKNOWN
+    if bucketing == "linear":
+        return _label(math.floor(number / HEIGHT_BUCKET) * HEIGHT_BUCKET)
+    # magnitude: 0, 1, 10, 100, ... (limite inferior del orden de magnitud)
+    return "0" if number < 1 else _label(10 ** math.floor(math.log10(number)))
+
+def _row_buckets(kind, row):
+    model, metrics = METRICS[kind]
+    keys = [("count", "all")]
+    for metric, column, bucketing in metrics:
+        keys.append((metric, bucket(bucketing, row[column])))
+    return keys
+
+def _apply(kind, deltas):
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    rows = [{"kind": kind, "metric": metric, "bucket": bucket_name, "count": delta}
+            for (metric, bucket_name), delta in deltas.items()]
+    dialect = db.engine.dialect.name
+
+    if dialect in ("sqlite", "postgresql"):
+        # un solo INSERT ... ON CONFLICT DO UPDATE para todos los buckets de la fila
+        upsert = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(CatalogStat).values(rows)
+        db.session.execute(upsert.on_conflict_do_update(
+            index_elements=["kind", "metric", "bucket"],
+            set_={"count": CatalogStat.count + upsert.excluded["count"]}
+        ))
+        return
+
+    for row in rows:
+        result = db.session.execute(update(CatalogStat).where(
+            CatalogStat.kind == kind, CatalogStat.metric == row["metric"], CatalogStat.bucket == row["bucket"]
+        ).values(count=CatalogStat.count + row["count"]))
+        if result.rowcount == 0:
+            db.session.execute(insert(CatalogStat).values(**row))
+
+def add_rows(kind, rows):
+    """rows: dicts with at least the stat columns of kind, e.g. serialize() output."""
+    deltas = Counter()
+    for row in rows:
+        for key in _row_buckets(kind, row):
+            deltas[key] += 1
+    _apply(kind, deltas)
+
+def remove_rows(kind, rows):
+    deltas = Counter()
+    for row in rows:
+        for key in _row_buckets(kind, row):
+            deltas[key] -= 1
+    _apply(kind, deltas)
+
+def replace_row(kind, old, new):
+    deltas = Counter()
+    for key in _row_buckets(kind, old):
+        deltas[key] -= 1
+    for key in _row_buckets(kind, new):
+        deltas[key] += 1
+    _apply(kind, deltas)
+
+def _vector_buckets(bucketing, values):
+    """Same buckets as bucket(), computed over the whole column at once."""
+    if bucketing == "category":
+        labels, counts = np.unique(np.array(values, dtype=str), return_counts=True)
+        return dict(zip(labels.tolist(), counts.tolist()))
+
+    # el catalogo repite mucho ("unknown", "1000", ...): se parsea cada texto distinto una vez
+    texts, positions = np.unique(np.array(values, dtype=str), return_inverse=True)
+    numbers = np.array([_to_number(value) for value in texts.tolist()], dtype=float)[positions] # None -> nan
+    known = numbers[~np.isnan(numbers)]
+    result = {}
+    if len(known) < len(numbers):
+        result[UNKNOWN] = int(len(numbers) - len(known))
+
+    if bucketing == "linear":
+        lower = np.floor(known / HEIGHT_BUCKET) * HEIGHT_BUCKET
+    else:
+        lower = np.zeros_like(known)
+        positive = known >= 1
+        lower[positive] = 10.0 ** np.floor(np.log10(known[positive]))
+
+    labels, counts = np.unique(lower, return_counts=True)
+    for label, count in zip(labels.tolist(), counts.tolist()):
+        result[_label(label)] = count
+    return result
+
+def rebuild(kind):
+    """Recompute every counter of kind from the catalog table. Catalog writes wait until the
+    transaction ends, otherwise a write committed between the SELECT and the DELETE would
+    lose its counters."""
+    model, metrics = METRICS[kind]
+    columns = stat_columns(kind)
+
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        # SHARE choca con el ROW EXCLUSIVE de los INSERT/UPDATE/DELETE: espera a los que estan en curso
+        db.session.execute(text("LOCK TABLE %s IN SHARE MODE" % model.__tablename__))
+    # sqlite: el DELETE toma el lock de escritura antes del SELECT, nadie hace commit en el medio
+    db.session.execute(delete(CatalogStat).where(CatalogStat.kind == kind))
+    statement = select(*columns)
+    if dialect not in ("sqlite", "postgresql"):
+        statement = statement.with_for_update(read=True)
+    table = db.session.execute(statement).all()
+
+    rows = [{"kind": kind, "metric": "count", "bucket": "all", "count": len(table)}]
+    for index, (metric, column, bucketing) in enumerate(metrics):
+        values = [row[index] for row in table]
+        for bucket_name, count in _vector_buckets(bucketing, values).items():
+            rows.append({"kind": kind, "metric": metric, "bucket": bucket_name, "count": count})
+
+    db.session.execute(insert(CatalogStat), rows)
+    return len(table)
+
+def setup_stats(app):
+
+    @app.route('/stats/<kind>', methods=['GET'])
+    @read_only
+    @single_flight
+    def get_stats(kind):
+        if kind not in METRICS:
+            raise APIException('Unknown kind, use people, planets or vehicles', status_code=404)
+
+        rows = db.session.execute(
+            select(CatalogStat.metric, CatalogStat.bucket, CatalogStat.count).where(CatalogStat.kind == kind, CatalogStat.count != 0)
+        ).all()
+
+        model, metrics = METRICS[kind]
+        response_body = {"msg": "ok", "kind": kind, "count": 0}
+        response_body.update({metric: {} for metric, column, bucketing in metrics})
+        for metric, bucket_name, count in rows:
+            if metric == "count":
+                response_body["count"] = count
+            else:
+                response_body[metric][bucket_name] = count
+
+        return jsonify(response_body), 200
+
+    @app.cli.command("stats-rebuild")
+    @click.argument("kinds", nargs=-1)
+    def stats_rebuild(kinds):
+        """Recompute /stats counters from the catalog (all kinds by default)."""
+        for kind in kinds or METRICS.keys():
+            if kind not in METRICS:
+                raise click.ClickException("Unknown kind %s" % kind)
+            total = rebuild(kind)
+            click.echo("%s: %d rows" % (kind, total))
+        db.session.commit()
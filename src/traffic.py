@@ -0,0 +1,188 @@
+"""
+Traffic capture and replay for load tests with the real mix of endpoints. With
+TRAFFIC_CAPTURE_PATH set every request is written as one compact JSON line to a rotating
+file, with passwords and tokens scrubbed (the JWT is replaced by its user id).
+`flask traffic-replay` re-issues the captured requests against a running instance, at the
+original timing or faster, and reports latency percentiles and error rates per endpoint.
+"""
+import os
+import re
+import json
+import time
+import random
+import logging
+import threading
+import urllib.error
+import urllib.request
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import g, request
+from flask_jwt_extended import create_access_token, decode_token
+
+import queries
+from identity import identity_claims
+from models import User
+from slowlog import percentile
+
+logger = logging.getLogger("traffic")
+
+SECRET_KEYS = re.compile(r"(^|_)(pass(word|wd)?|token|secret|jti)$", re.IGNORECASE) # password, access_token... no passengers
+SCRUBBED = "***"
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+def scrub(value):
+    """Copy of a JSON body with the values of password/token-like keys replaced."""
+    if isinstance(value, dict):
+        return {key: SCRUBBED if SECRET_KEYS.search(str(key)) else scrub(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+def _user_of(authorization):
+    """User id of a Bearer token, the token itself is never written."""
+    if not authorization.startswith("Bearer "):
+        return None
+    try:
+        return decode_token(authorization[7:], allow_expired=True)["sub"]
+    except Exception:
+        return None
+
+def endpoint_shape(method, path):
+    """GET /favorites/12?x=1 -> GET /favorites/<id>, to group the report."""
+    return "%s %s" % (method, _ID_SEGMENT.sub("/<id>", path.split("?", 1)[0]))
+
+def setup_traffic_capture(app):
+
+    @app.cli.command("traffic-replay")
+    @click.argument("files", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+    @click.option("--target", default="http://127.0.0.1:3000", show_default=True, help="Base URL of the instance under test.")
+    @click.option("--speed", default=1.0, show_default=True, help="Rate multiplier, 2 replays twice as fast, 0 sends as fast as possible.")
+    @click.option("--concurrency", default=8, show_default=True, help="Requests in flight at the same time.")
+    @click.option("--limit", default=0, help="Replay only the first N requests.")
+    @click.option("--timeout", default=10.0, show_default=True, help="Seconds per request.")
+    def traffic_replay(files, target, speed, concurrency, limit, timeout):
+        """Replay captured traffic (oldest file first, e.g. capture.log.2 capture.log.1 capture.log)."""
+        records = []
+        for name in files:
+            with open(name) as capture:
+                records.extend(json.loads(line) for line in capture if line.strip())
+        records.sort(key=lambda record: record["t"])
+        if limit:
+            records = records[:limit]
+        if not records:
+            raise click.ClickException("no requests captured in %s" % ", ".join(files))
+
+        # tokens nuevos para los usuarios capturados, firmados con la clave de esta app y con
+        # los claims de identity.py; los usuarios que ya no existen no tendrian un token valido
+        tokens = {}
+        for record in records:
+            if "u" in record and record["u"] not in tokens:
+                user = queries.get_by_id(User, record["u"])
+                tokens[record["u"]] = create_access_token(identity=user.id, additional_claims=identity_claims(user)) if user else None
+        missing = [user_id for user_id, token in tokens.items() if token is None]
+        if missing:
+            records = [record for record in records if tokens.get(record.get("u"), True) is not None]
+            click.echo("skipping the requests of %d users that no longer exist" % len(missing))
+            if not records:
+                raise click.ClickException("every captured request belongs to a user that no longer exists")
+
+        results = []
+        lock = threading.Lock()
+
+        def send(record, submitted):
+            headers = {}
+            data = None
+            if "b" in record:
+                data = json.dumps(record["b"]).encode("utf-8")
+                headers["Content-Type"] = "application/json"
+            if "u" in record:
+                headers["Authorization"] = "Bearer " + tokens[record["u"]]
+
+            replay = urllib.request.Request(target.rstrip("/") + record["p"], data=data, headers=headers, method=record["m"])
+            start = time.perf_counter()
+            queued_ms = (start - submitted) * 1000 # esperando un thread libre: la concurrencia no alcanza
+            try:
+                with urllib.request.urlopen(replay, timeout=timeout) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as error:
+                status = error.code
+            except Exception:
+                status = None # error de conexion o timeout
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with lock:
+                results.append((endpoint_shape(record["m"], record["p"]), status, record.get("s"), elapsed_ms, queued_ms))
+
+        first = records[0]["t"]
+        max_lag = 0.0
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for record in records:
+                if speed > 0:
+                    due = (record["t"] - first) / speed
+                    wait = due - (time.perf_counter() - started)
+                    if wait > 0:
+                        time.sleep(wait)
+                    else:
+                        max_lag = max(max_lag, -wait)
+                executor.submit(send, record, time.perf_counter())
+        elapsed = time.perf_counter() - started
+
+        _report(results, elapsed, max_lag)
+
+    path = os.getenv("TRAFFIC_CAPTURE_PATH")
+    if not path:
+        return
+
+    sample = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE", 1))
+    handler = RotatingFileHandler(path, maxBytes=int(os.getenv("TRAFFIC_CAPTURE_MAX_BYTES", 50 * 1024 * 1024)),
+                                  backupCount=int(os.getenv("TRAFFIC_CAPTURE_BACKUPS", 5)))
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    @app.before_request
+    def start_capture():
+        g.capture_start = time.time()
+
+    @app.after_request
+    def capture_request(response):
+        # las rutas /internal llevan la clave interna y no son trafico de clientes, el warmup tampoco
+        if request.path.startswith("/internal") or request.environ.get("warmup") or random.random() >= sample or "capture_start" not in g:
+            return response
+
+        record = {"t": round(g.capture_start, 4), "m": request.method, "p": request.full_path.rstrip("?")}
+        body = request.get_json(silent=True)
+        if body is not None:
+            record["b"] = scrub(body)
+        user = _user_of(request.headers.get("Authorization", ""))
+        if user is not None:
+            record["u"] = user
+        record["s"] = response.status_code
+        record["d"] = round((time.time() - g.capture_start) * 1000, 2)
+        logger.info(json.dumps(record, separators=(",", ":")))
+        return response
+
+def _report(results, elapsed, max_lag):
+    by_endpoint = {}
+    for shape, status, original_status, elapsed_ms, queued_ms in results:
+        by_endpoint.setdefault(shape, []).append((status, original_status, elapsed_ms))
+
+    click.echo("%d requests in %.2f s (%.1f req/s), max schedule lag %.1f ms, max queued %.1f ms" % (
+        len(results), elapsed, len(results) / elapsed if elapsed else 0, max_lag * 1000,
+        max((row[4] for row in results), default=0)))
+    click.echo("%-40s %7s %9s %9s %9s %9s %7s %7s %9s" % (
+        "endpoint", "count", "p50_ms", "p95_ms", "p99_ms", "max_ms", "5xx%", "fail%", "changed%"))
+
+    for shape, rows in sorted(by_endpoint.items(), key=lambda item: -len(item[1])):
+        timings = sorted(row[2] for row in rows)
+        server_errors = sum(1 for status, original, ms in rows if status is not None and status >= 500)
+        failures = sum(1 for status, original, ms in rows if status is None)
+        # distinto status que en la captura (p. ej. 401 del /login con password borrado)
+        changed = sum(1 for status, original, ms in rows if original is not None and status != original)
+        click.echo("%-40s %7d %9.1f %9.1f %9.1f %9.1f %7.1f %7.1f %9.1f" % (
+            shape[:40], len(rows), percentile(timings, 50), percentile(timings, 95), percentile(timings, 99),
+            timings[-1], 100.0 * server_errors / len(rows), 100.0 * failures / len(rows), 100.0 * changed / len(rows)))
@@ -1,4 +1,6 @@
-from flask import jsonify, url_for
+import hmac
+from functools import wraps
+from flask import jsonify, url_for, request, current_app
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +17,36 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def _parse_list(name, allowed):
+    values = []
+    for value in request.args.get(name, "").split(","):
+        value = value.strip()
+        if value and value not in values:
+            values.append(value)
+
+    unknown = [value for value in values if value not in allowed]
+    if unknown:
+        raise APIException("Unknown %s: %s, use %s" % (name, ", ".join(unknown), ", ".join(allowed)), status_code=400)
+    return tuple(values)
+
+def parse_fields(allowed):
+    """?fields=id,name -> ("id", "name"), every allowed field when the parameter is missing."""
+    return _parse_list("fields", allowed) or tuple(allowed)
+
+def parse_include(allowed):
+    """?include=user,people -> ("user", "people"), nothing is embedded by default."""
+    return _parse_list("include", allowed)
+
+def internal_only(f):
+    """Only allow requests with an X-Internal-Key header matching INTERNAL_API_KEY."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = current_app.config.get("INTERNAL_API_KEY")
+        if not key or not hmac.compare_digest(request.headers.get("X-Internal-Key", ""), key):
+            raise APIException("Forbidden", status_code=403)
+        return f(*args, **kwargs)
+    return decorated
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
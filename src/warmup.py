@@ -0,0 +1,148 @@
+"""
+Warmup and probes. /healthz only says the process is alive, /readyz says it can take
+traffic: 503 until the warmup of this worker finished, then a SELECT 1 on the primary.
+The warmup (started from wsgi.py, in the background so the probes answer meanwhile) opens
+the pool of every engine to its minimum size and runs each hot query shape once, so the
+first real requests do not pay for connecting and compiling statements.
+"""
+import os
+import time
+import threading
+
+import click
+from flask import jsonify
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+
+from models import db
+
+# rutas GET calientes, los id 0 no existen pero compilan la misma consulta que el detalle
+WARMUP_PATHS = (
+    "/people", "/people/0", "/planets", "/planets/0", "/vehicles", "/vehicles/0", "/user/0",
+    "/stats/people", "/stats/planets", "/stats/vehicles", "/favorites/report", "/changes"
+)
+
+class Warmup:
+
+    def __init__(self):
+        self.status = "not started" # not started, running, done, failed
+        self.started_at = None
+        self.finished_at = None
+        self.steps = []
+        self.error = None
+        self._extra_steps = []
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        # sin warmup (p. ej. `flask run`) no hay nada que esperar
+        return self.status in ("not started", "done")
+
+    def add_step(self, name, fn):
+        """fn() runs inside an app context during the warmup, e.g. queries that need a token."""
+        self._extra_steps.append((name, fn))
+
+    def _step(self, name, fn):
+        start = time.perf_counter()
+        fn()
+        self.steps.append({"step": name, "ms": round((time.perf_counter() - start) * 1000, 1)})
+
+    def _claim(self):
+        with self._lock:
+            if self.status != "not started":
+                return False
+            self.status = "running"
+            return True
+
+    def run(self, app):
+        """Warm up in this thread, once."""
+        if self._claim():
+            self._run(app)
+
+    def start(self, app):
+        """Warm up in a background thread, retrying every WARMUP_RETRY_SECONDS if it fails."""
+        if not self._claim():
+            return
+
+        def run_until_done():
+            while not self._run(app):
+                time.sleep(float(os.getenv("WARMUP_RETRY_SECONDS", 5)))
+                self.status = "running"
+        threading.Thread(target=run_until_done, daemon=True).start()
+
+    def _run(self, app):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.steps = []
+        self.error = None
+
+        try:
+            with app.app_context():
+                for key, engine in db.engines.items():
+                    self._step("pool %s" % (key or "primary"), lambda: _open_pool(engine))
+
+                client = app.test_client()
+                for path in WARMUP_PATHS:
+                    # la grabacion de trafico ignora estas peticiones
+                    self._step("GET %s" % path, lambda: client.get(path, environ_overrides={"warmup": True}))
+
+                for name, fn in self._extra_steps:
+                    self._step(name, fn)
+                db.session.remove()
+        except Exception as error:
+            app.logger.exception("warmup failed")
+            self.error = "%s: %s" % (type(error).__name__, error)
+            self.status = "failed"
+        else:
+            self.status = "done"
+        self.finished_at = time.time()
+        return self.status == "done"
+
+    def report(self):
+        return {
+            "ready": self.ready,
+            "warmup": self.status,
+            "duration_ms": round((self.finished_at - self.started_at) * 1000, 1) if self.finished_at else None,
+            "steps": self.steps,
+            "error": self.error
+        }
+
+warmup = Warmup()
+
+def _open_pool(engine):
+    """Check out the minimum number of connections at the same time so the pool keeps them open."""
+    size = int(os.getenv("WARMUP_POOL_CONNECTIONS", 0)) or (engine.pool.size() if isinstance(engine.pool, QueuePool) else 1)
+    connections = []
+    try:
+        for _ in range(size):
+            connection = engine.connect()
+            connection.execute(text("SELECT 1"))
+            connections.append(connection)
+    finally:
+        for connection in connections:
+            connection.close()
+
+def setup_warmup(app):
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({"status": "ok"}), 200
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        report = warmup.report()
+        if report["ready"]:
+            try:
+                with db.engine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+            except Exception as error:
+                report.update(ready=False, error="database: %s" % error)
+        return jsonify(report), 200 if report["ready"] else 503
+
+    @app.cli.command("warmup")
+    def warmup_command():
+        """Run the warmup steps once and print how long each one took."""
+        warmup.run(app)
+        for step in warmup.steps:
+            click.echo("%-30s %8.1f ms" % (step["step"], step["ms"]))
+        click.echo("warmup %s" % warmup.status)
@@ -2,6 +2,11 @@
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
 from app import app as application
+from warmup import warmup
+
+# cada worker se calienta en segundo plano, /readyz responde 503 hasta que termine
+# (sin --preload: con preload el thread quedaria en el proceso master)
+warmup.start(application)
 
 if __name__ == "__main__":
     application.run()
@@ -0,0 +1,68 @@
+"""
+N concurrent identical GETs run the query once: the leader computes the response and the
+other requests get a copy of it.
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+
+DATABASE = os.path.join(tempfile.mkdtemp(), "singleflight.db")
+os.environ["DATABASE_URL"] = "sqlite:///" + DATABASE
+os.environ.setdefault("FLASK_APP_KEY", "test-key")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest
+from sqlalchemy import event
+
+from app import app
+from models import db, Planets
+
+REQUESTS = 8
+
+@pytest.fixture
+def catalog():
+    with app.app_context():
+        db.create_all()
+        db.session.add(Planets(name="Tatooine", population="200000", surface="1", diameter="10465"))
+        db.session.commit()
+        yield
+        db.session.remove()
+        db.drop_all()
+
+def test_concurrent_identical_gets_run_one_query(catalog):
+    selects = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "FROM planets" in statement:
+            selects.append(statement)
+            time.sleep(0.3) # el lider sigue en vuelo mientras llegan los demas
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+
+    barrier = threading.Barrier(REQUESTS)
+    responses = []
+
+    def get():
+        client = app.test_client()
+        barrier.wait()
+        response = client.get("/planets")
+        responses.append((response.status_code, response.get_data()))
+
+    try:
+        threads = [threading.Thread(target=get) for _ in range(REQUESTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    assert len(selects) == 1
+    assert len(responses) == REQUESTS
+    assert {status for status, body in responses} == {200}
+    assert len({body for status, body in responses}) == 1
+    assert b"Tatooine" in responses[0][1]